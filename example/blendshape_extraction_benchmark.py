@@ -0,0 +1,108 @@
+"""
+Times filling a blendshape matrix from per target delta arrays, the scalar per vertex loop that
+`get_blendshape_mat` used against the vectorized `target_entries` / `assemble_matrix` path, and the
+`list.index` row mapping of a vertex subset against the `row_lookup` table. Maya's point arrays are
+stood in for by plain arrays, so only the Python side is measured. Both fills pay for the `np.array`
+conversion of every MPointArray on top, which reads each MPoint through the sequence protocol. It is
+timed on a Python sequence of (x, y, z, w) tuples, a lower bound, real MPoints also go through Maya's
+bindings. Runs outside of Maya:
+
+    python example/blendshape_extraction_benchmark.py
+"""
+
+import timeit
+import numpy as np
+
+from hbtools.numpy.blendshapes import row_lookup, target_entries, assemble_matrix
+
+
+def _targets(vertices, targets, moved, seed=0):
+    rng = np.random.RandomState(seed)
+    result = []
+    for _ in range(targets):
+        indices = np.sort(rng.choice(vertices, int(moved * vertices), replace=False))
+        result.append((rng.normal(size=(len(indices), 3)), indices))
+    return result
+
+
+def _scalar_fill(targets, vertices):
+    matrix = np.zeros((3 * vertices, len(targets)))
+    for column, (points, indices) in enumerate(targets):
+        points = points.tolist()
+        indices = indices.tolist()
+        for j in range(len(indices)):
+            m_index = indices[j]
+            matrix[3 * m_index, column] = points[j][0]
+            matrix[3 * m_index + 1, column] = points[j][1]
+            matrix[3 * m_index + 2, column] = points[j][2]
+    return matrix
+
+
+class _PointSequence(object):
+    """ Indexes to (x, y, z, w) like an MPointArray of MPoints. """
+    def __init__(self, points):
+        self._points = [tuple(point) + (1.,) for point in points.tolist()]
+
+    def __len__(self):
+        return len(self._points)
+
+    def __getitem__(self, index):
+        return self._points[index]
+
+
+def _convert_points(sequences):
+    # As _get_target_arrays in maya2numpy converts the deltas of a target.
+    return [np.array(points, dtype=np.float64).reshape(-1, 4)[:, :3] for points in sequences]
+
+
+def _vectorized_fill(targets, vertices, sparse=None):
+    columns = [target_entries(points, indices) for points, indices in targets]
+    return assemble_matrix(columns, 3 * vertices, sparse=sparse)
+
+
+def _scalar_rows(targets, indices):
+    rows = []
+    for _, target_indices in targets:
+        for v in target_indices.tolist():
+            try:
+                rows.append(indices.index(v))
+            except ValueError:
+                pass
+    return rows
+
+
+def _lookup_rows(targets, indices, vertices):
+    lookup = row_lookup(indices, vertices)
+    return [lookup[target_indices] for _, target_indices in targets]
+
+
+def benchmark(vertices=50000, targets=50, repeat=3):
+    for moved in (0.05, 0.2, 0.5):
+        data = _targets(vertices, targets, moved)
+        print("{} vertices, {} targets moving {:.0%} of them".format(vertices, targets, moved))
+
+        scalar = min(timeit.repeat(lambda: _scalar_fill(data, vertices), number=1, repeat=repeat)) / targets
+        dense = min(timeit.repeat(lambda: _vectorized_fill(data, vertices), number=1, repeat=repeat)) / targets
+        sparse = min(timeit.repeat(lambda: _vectorized_fill(data, vertices, "csc"), number=1,
+                                   repeat=repeat)) / targets
+        sequences = [_PointSequence(points) for points, _ in data]
+        convert = min(timeit.repeat(lambda: _convert_points(sequences), number=1, repeat=repeat)) / targets
+        per_vertex = 1e9 / (moved * vertices)
+        print("  scalar:     {:8.2f} ms/target {:8.1f} ns/vertex".format(scalar * 1e3, scalar * per_vertex))
+        print("  vectorized: {:8.2f} ms/target {:8.1f} ns/vertex".format(dense * 1e3, dense * per_vertex))
+        print("  sparse csc: {:8.2f} ms/target {:8.1f} ns/vertex".format(sparse * 1e3, sparse * per_vertex))
+        print("  MPoints:    {:8.2f} ms/target {:8.1f} ns/vertex".format(convert * 1e3, convert * per_vertex))
+
+    data = _targets(vertices, 5, 0.2)
+    for markers in (60, 600):
+        indices = sorted(np.random.RandomState(1).choice(vertices, markers, replace=False).tolist())
+        scalar = min(timeit.repeat(lambda: _scalar_rows(data, indices), number=1, repeat=repeat)) / len(data)
+        lookup = min(timeit.repeat(lambda: _lookup_rows(data, indices, vertices), number=1,
+                                   repeat=repeat)) / len(data)
+        print("{} of {} vertices selected, row mapping of targets moving 20%".format(markers, vertices))
+        print("  list.index: {:8.2f} ms/target".format(scalar * 1e3))
+        print("  row_lookup: {:8.2f} ms/target".format(lookup * 1e3))
+
+
+if __name__ == '__main__':
+    benchmark()
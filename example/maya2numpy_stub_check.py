@@ -0,0 +1,340 @@
+"""
+Runs `get_blendshape_mat` outside of Maya against stand-ins for maya.cmds and maya.api.OpenMaya, and
+compares it with the scalar per vertex fill it replaced: dense and sparse matrices, all vertices and
+a vertex subset, with and without z and painted target weights. The painted weights are read both
+ways getAttr can answer a range of a sparse multi attribute, with every element of the range or only
+the painted ones, and dropped after painting, deleting the node or opening another scene with a
+node of the same name. The stand-ins only model the calls maya2numpy makes:
+
+    python example/maya2numpy_stub_check.py
+"""
+
+import re
+import sys
+import types
+import numpy as np
+
+
+# Stand-ins #
+
+
+class _Scene(object):
+    """ One blendshape node "blendShape1" on a mesh of vertex_count vertices.
+
+    targets maps the logical index of every target to its (n, 3) deltas and (n,) vertex indices, both None
+    for a target without deltas. weights maps the logical index of a target to its painted {vertex: weight}.
+    """
+    def __init__(self, vertex_count, targets, weights, dense_ranges=True):
+        self.vertex_count = vertex_count
+        self.targets = targets
+        self.weights = weights
+        self.dense_ranges = dense_ranges
+
+
+class _MObject(object):
+    def __init__(self, value=None):
+        self.value = value
+
+    def isNull(self):
+        return self.value is None
+
+
+class _Plug(object):
+    def __init__(self, children=(), elements=None, value=None):
+        self._children = list(children)
+        self._elements = elements or {}
+        self._value = value
+
+    def child(self, index):
+        return self._children[index]
+
+    def elementByPhysicalIndex(self, index):
+        return self._elements[sorted(self._elements)[index]]
+
+    def elementByLogicalIndex(self, index):
+        return self._elements[index]
+
+    def getExistingArrayAttributeIndices(self):
+        return sorted(self._elements)
+
+    def asMObject(self):
+        return _MObject(self._value)
+
+
+class _WeightPlug(object):
+    def __init__(self, name):
+        self._name = name
+
+    def partialName(self, useFullAttributePath=False, useLongNames=False):
+        return self._name
+
+
+class _MPointArray(object):
+    """ Indexes to (x, y, z, w) like an MPointArray of MPoints, so np.array gives (n, 4). """
+    def __init__(self, points):
+        self._points = points
+
+    def __len__(self):
+        return len(self._points)
+
+    def __getitem__(self, index):
+        x, y, z = self._points[index]
+        return (x, y, z, 1.)
+
+
+class _MFnDependencyNode(object):
+    def __init__(self, node):
+        self._node = node
+
+    def findPlug(self, name, want_networked):
+        scene = self._node
+        groups = {}
+        for logical, (points, indices) in scene.targets.items():
+            components = [] if indices is None else [list(indices)]
+            item = _Plug(children=[None, None, None, _Plug(value=points), _Plug(value=components)])
+            groups[logical] = _Plug(children=[_Plug(elements={6000: item})])
+        plugs = {
+            'inputTarget': _Plug(elements={0: _Plug(children=[_Plug(elements=groups)])}),
+            'outputGeometry': _Plug(elements={0: _Plug(value=scene.vertex_count)}),
+        }
+        return plugs[name]
+
+
+class _MSelectionList(object):
+    def __init__(self):
+        self._names = []
+
+    def add(self, name):
+        self._names.append(name)
+
+    def getDependNode(self, index):
+        return _scenes[self._names[index]]
+
+
+class _MFnMesh(object):
+    def __init__(self, mesh):
+        self.numVertices = mesh.value
+
+
+class _MFnPointArrayData(object):
+    def __init__(self, data):
+        self._points = data.value
+
+    def array(self):
+        return _MPointArray(self._points)
+
+
+class _MFnComponentListData(object):
+    def __init__(self, data):
+        self._components = data.value
+
+    def length(self):
+        return len(self._components)
+
+    def get(self, index):
+        return self._components[index]
+
+
+class _MFnSingleIndexedComponent(object):
+    def __init__(self, component):
+        self._elements = component
+
+    def getElements(self):
+        return list(self._elements)
+
+
+class _MObjectHandle(object):
+    def __init__(self, node):
+        self._node = node
+
+    def hashCode(self):
+        return id(self._node)
+
+
+def _add_callback(source, function, client_data=None):
+    callback_id = max(_callbacks or [0]) + 1
+    _callbacks[callback_id] = (source, function, client_data)
+    return callback_id
+
+
+def _fire(source, *args):
+    """ Calls the callbacks registered on source like Maya would, with args before the client data. """
+    for callback_id, (callback_source, function, client_data) in list(_callbacks.items()):
+        if callback_source == source and callback_id in _callbacks:
+            function(*(args + (client_data,)))
+
+
+class _MNodeMessage(object):
+    @staticmethod
+    def addAttributeChangedCallback(node, function, client_data=None):
+        return _add_callback((node, 'attributeChanged'), function, client_data)
+
+    @staticmethod
+    def addNodePreRemovalCallback(node, function, client_data=None):
+        return _add_callback((node, 'preRemoval'), function, client_data)
+
+
+class _MSceneMessage(object):
+    kAfterNew = 'afterNew'
+    kAfterOpen = 'afterOpen'
+
+    @staticmethod
+    def addCallback(message, function, client_data=None):
+        return _add_callback(message, function, client_data)
+
+
+class _MMessage(object):
+    @staticmethod
+    def removeCallback(callback_id):
+        del _callbacks[callback_id]
+
+
+_WEIGHTS = re.compile(r'^(\w+)\.inputTarget\[0\]\.inputTargetGroup\[(\d+)\]\.targetWeights(?:\[(\d+):(\d+)\])?$')
+
+
+def _get_attr(attribute, multiIndices=False):
+    node, target, start, end = _WEIGHTS.match(attribute).groups()
+    scene = _scenes[node]
+    painted = scene.weights.get(int(target), {})
+    if multiIndices:
+        return sorted(painted) or None
+
+    start, end = int(start), int(end)
+    if scene.dense_ranges:
+        values = [painted.get(v, 1.) for v in range(start, end + 1)]
+    else:
+        values = [painted[v] for v in sorted(painted) if start <= v <= end]
+    # A single element comes back as a plain value.
+    return values[0] if len(values) == 1 else values
+
+
+_scenes = {}      # node name: _Scene of the node currently called that.
+_callbacks = {}   # callback id: (source, function, client data).
+
+
+def _install():
+    """ Puts the stand-ins in sys.modules under the names maya2numpy imports. """
+    maya = types.ModuleType('maya')
+    cmds = types.ModuleType('maya.cmds')
+    cmds.getAttr = _get_attr
+    api = types.ModuleType('maya.api')
+    api2 = types.ModuleType('maya.api.OpenMaya')
+    for name, value in (('MSelectionList', _MSelectionList), ('MFnDependencyNode', _MFnDependencyNode),
+                        ('MFnMesh', _MFnMesh), ('MFnPointArrayData', _MFnPointArrayData),
+                        ('MFnComponentListData', _MFnComponentListData),
+                        ('MFnSingleIndexedComponent', _MFnSingleIndexedComponent),
+                        ('MObjectHandle', _MObjectHandle), ('MNodeMessage', _MNodeMessage),
+                        ('MSceneMessage', _MSceneMessage), ('MMessage', _MMessage)):
+        setattr(api2, name, value)
+
+    maya.cmds, maya.api, api.OpenMaya = cmds, api, api2
+    for module in (maya, cmds, api, api2):
+        sys.modules[module.__name__] = module
+
+
+# Check #
+
+
+def _scene(vertex_count=40, seed=0):
+    rng = np.random.RandomState(seed)
+    targets = {}
+    # Logical indices with gaps, target 4 has no deltas.
+    for logical in (0, 1, 3, 6):
+        indices = np.sort(rng.choice(vertex_count, vertex_count // 3, replace=False))
+        targets[logical] = (rng.normal(size=(len(indices), 3)).tolist(), indices.tolist())
+    targets[4] = (None, None)
+
+    painted_1 = rng.choice(vertex_count - 5, 8, replace=False)
+    weights = {1: dict(zip(painted_1.tolist(), rng.uniform(size=8).tolist())),
+               # Only the first vertex is painted, a range of a single element.
+               3: {0: 0.25}}
+    return _Scene(vertex_count, targets, weights)
+
+
+def _scalar_fill(scene, indices=None, include_z=True, apply_vertex_weight_map=True):
+    """ The matrix the per vertex loop of get_blendshape_mat filled. """
+    dimensions = 3 if include_z else 2
+    rows = dimensions * (scene.vertex_count if indices is None else len(indices))
+    matrix = np.zeros((rows, len(scene.targets)))
+    for column, logical in enumerate(sorted(scene.targets)):
+        points, target_indices = scene.targets[logical]
+        painted = scene.weights.get(logical, {}) if apply_vertex_weight_map else {}
+        for j, vertex in enumerate(target_indices or []):
+            try:
+                m_index = vertex if indices is None else indices.index(vertex)
+            except ValueError:
+                continue
+            for axis in range(dimensions):
+                matrix[dimensions * m_index + axis, column] = points[j][axis] * painted.get(vertex, 1.)
+    return matrix
+
+
+def check():
+    _install()
+    import hbtools.maya.maya2numpy as m2n
+
+    scene = _scene()
+    _scenes['blendShape1'] = scene
+    # A subset out of order, with a vertex no target moves.
+    moved = sorted(set(v for _, indices in scene.targets.values() for v in indices or []))
+    still = sorted(set(range(scene.vertex_count)) - set(moved))
+    subset = moved[::3][::-1] + still[:1]
+
+    for dense_ranges in (True, False):
+        scene.dense_ranges = dense_ranges
+        m2n.clear_weight_map_cache()
+        for indices in (None, subset):
+            for include_z in (True, False):
+                for apply_weights in (True, False):
+                    expected = _scalar_fill(scene, indices, include_z, apply_weights)
+                    for sparse in (None, 'csc', 'csr'):
+                        matrix, target_indices = m2n.get_blendshape_mat('blendShape1', indices=indices,
+                                                                        include_z=include_z,
+                                                                        apply_vertex_weight_map=apply_weights,
+                                                                        sparse=sparse)
+                        assert list(target_indices) == sorted(scene.targets)
+                        if sparse is not None:
+                            assert matrix.format == sparse
+                            matrix = matrix.toarray()
+                        difference = np.abs(matrix - expected).max()
+                        assert difference == 0., "Matrix differs from the scalar fill by {}".format(difference)
+        print("dense_ranges={:<5} matches the scalar fill".format(str(dense_ranges)))
+
+    # Painting a weight drops the cached weight maps of the node.
+    vertex = sorted(scene.weights[1])[0]
+    scene.weights[1][vertex] = 0.5
+    m2n.get_blendshape_mat('blendShape1')
+    _fire((scene, 'attributeChanged'), None,
+          _WeightPlug('inputTarget[0].inputTargetGroup[1].targetWeights[{}]'.format(vertex)), None)
+    matrix, _ = m2n.get_blendshape_mat('blendShape1')
+    assert np.abs(matrix - _scalar_fill(scene)).max() == 0., "Stale weight map after painting"
+    print("painted weights are re-read after a change")
+
+    # Another scene with a node of the same name, the old one stays alive so its id is not reused.
+    for message in (_MSceneMessage.kAfterOpen, _MSceneMessage.kAfterNew, None):
+        previous, scene = scene, _scene(seed=len(_callbacks) + 1)
+        if message is None:
+            _fire((previous, 'preRemoval'), previous)
+            assert not [source for source, _, _ in _callbacks.values() if source[0] is previous], \
+                "Callbacks left on a deleted node"
+        else:
+            _fire(message)
+        _scenes['blendShape1'] = scene
+        matrix, _ = m2n.get_blendshape_mat('blendShape1')
+        assert np.abs(matrix - _scalar_fill(scene)).max() == 0., "Weight maps of the previous node after {}".format(
+            message or "deleting it")
+
+        # The new node is watched.
+        vertex = sorted(scene.weights[1])[0]
+        scene.weights[1][vertex] = 0.5
+        _fire((scene, 'attributeChanged'), None,
+              _WeightPlug('inputTarget[0].inputTargetGroup[1].targetWeights[{}]'.format(vertex)), None)
+        matrix, _ = m2n.get_blendshape_mat('blendShape1')
+        assert np.abs(matrix - _scalar_fill(scene)).max() == 0., "Stale weight map after painting the new node"
+    print("weight maps follow the node through file new, open and deletion")
+
+    m2n.clear_weight_map_cache()
+    assert not _callbacks
+
+if __name__ == '__main__':
+    check()
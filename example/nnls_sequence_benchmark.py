@@ -0,0 +1,61 @@
+"""
+Times `GramNNLSSolver.solve_sequence` on smooth takes, warm started (frames that share a passive set
+solved together) against a `solve` per frame (warm_start=False) and against warm starting the
+active-set iteration of `nnls_active_set` frame by frame from the previous passive set. The rigs with
+more targets than rows have linearly dependent targets. Runs outside of Maya:
+
+    python example/nnls_sequence_benchmark.py
+"""
+
+import timeit
+import numpy as np
+
+from hbtools.numpy.solvers import GramNNLSSolver, nnls_active_set
+
+
+def _take(rows, targets, frames, seed=0):
+    rng = np.random.RandomState(seed)
+    matrix = rng.normal(size=(rows, targets)) * (rng.rand(rows, targets) < 0.3)
+    # Half the targets animate, slow curves clipped at 0, seen through noisy points.
+    time = np.linspace(0., 6., frames)[:, np.newaxis]
+    weights = np.clip(np.sin(3. * rng.rand(targets) * time + 6. * rng.rand(targets)), 0., None)
+    weights *= rng.rand(targets) < 0.5
+    return matrix, weights.dot(matrix.T) + 0.5 * rng.normal(size=(frames, rows))
+
+
+def _per_frame_warm_start(solver, targets):
+    projected = np.asarray(solver._matrix.T.dot(targets.T)).T
+    weights = np.empty((len(targets), projected.shape[1]))
+    passive = None
+    for i in range(len(targets)):
+        weights[i], _ = nnls_active_set(solver._gram, projected[i], passive=passive)
+        passive = weights[i] > 0
+    return weights
+
+
+def benchmark(shapes=((180, 60), (180, 200), (600, 200), (1500, 150)), frames=300, repeat=3):
+    for rows, targets in shapes:
+        matrix, take = _take(rows, targets, frames)
+        solver = GramNNLSSolver()
+        solver.prepare(matrix)
+
+        timings = {}
+        results = {}
+        methods = (('warm start', lambda: solver.solve_sequence(take)[0]),
+                   ('solve loop', lambda: solver.solve_sequence(take, warm_start=False)[0]),
+                   ('per frame warm start', lambda: _per_frame_warm_start(solver, take)))
+        # Interleaved, so a noisy machine slows all methods alike.
+        for _ in range(repeat):
+            for name, method in methods:
+                start = timeit.default_timer()
+                results[name] = method()
+                timings[name] = min(timings.get(name, np.inf), timeit.default_timer() - start)
+
+        difference = max(np.abs(results[name] - results['solve loop']).max() for name, _ in methods)
+        print("{:>4} x {:<3} {}  max difference: {:.1e}".format(rows, targets, "  ".join(
+            "{}: {:5.2f} ms/frame".format(name, timings[name] * 1e3 / frames) for name, _ in methods),
+            difference))
+
+
+if __name__ == '__main__':
+    benchmark()
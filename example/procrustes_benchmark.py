@@ -0,0 +1,80 @@
+"""
+Times the general SVD path of `procrustes` against the closed-form 'horn' path, both for single
+pairs and for stacked sequences. Single pairs take the SVD path with either method, and are also
+timed against the plain MATLAB port `procrustes` started from. Runs outside of Maya:
+
+    python example/procrustes_benchmark.py
+"""
+
+import timeit
+import numpy as np
+
+from hbtools.numpy.procrustus import procrustes, procrustes_batch
+
+
+def _sequence(frames, markers, seed=0):
+    rng = np.random.RandomState(seed)
+    X = rng.normal(size=(frames, markers, 3))
+    Y = X + 0.01 * rng.normal(size=X.shape)
+    return X, Y
+
+
+def _plain_procrustes(X, Y, scaling=True, reflection='best'):
+    """ The unweighted float64 single pair `procrustes` of the original port, for reference. """
+    muX = X.mean(0)
+    muY = Y.mean(0)
+    X0 = X - muX
+    Y0 = Y - muY
+    ssX = (X0**2.).sum()
+    ssY = (Y0**2.).sum()
+    normX = np.sqrt(ssX)
+    normY = np.sqrt(ssY)
+    X0 /= normX
+    Y0 /= normY
+
+    A = np.dot(X0.T, Y0)
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    V = Vt.T
+    T = np.dot(V, U.T)
+    if reflection != 'best':
+        have_reflection = np.linalg.det(T) < 0
+        if reflection != have_reflection:
+            V[:, -1] *= -1
+            s[-1] *= -1
+            T = np.dot(V, U.T)
+    traceTA = s.sum()
+
+    if scaling:
+        b = traceTA * normX / normY
+        d = 1 - traceTA**2
+        Z = normX*traceTA*np.dot(Y0, T) + muX
+    else:
+        b = 1
+        d = 1 + ssY/ssX - 2 * traceTA * normY / normX
+        Z = normY*np.dot(Y0, T) + muX
+    c = muX - b*np.dot(muY, T)
+    return d, Z, {'rotation': T, 'scale': b, 'translation': c}
+
+
+def benchmark(frames=20000, markers=60, single_pairs=2000, repeat=3):
+    X, Y = _sequence(frames, markers)
+    print("{} frames of {} markers".format(frames, markers))
+
+    for reflection in ('best', False):
+        plain = min(timeit.repeat(
+            lambda: [_plain_procrustes(X[i], Y[i], reflection=reflection) for i in range(single_pairs)],
+            number=1, repeat=repeat)) / single_pairs
+        print("reflection={:<5} plain port    single: {:8.2f} us/pair".format(str(reflection), plain * 1e6))
+        for method in ('svd', 'horn'):
+            single = min(timeit.repeat(
+                lambda: [procrustes(X[i], Y[i], reflection=reflection, method=method) for i in range(single_pairs)],
+                number=1, repeat=repeat)) / single_pairs
+            batch = min(timeit.repeat(
+                lambda: procrustes_batch(X, Y, reflection=reflection, method=method),
+                number=1, repeat=repeat)) / frames
+            print("reflection={:<5} method={:<4}  single: {:8.2f} us/pair  batch: {:8.2f} us/frame".format(
+                str(reflection), method, single * 1e6, batch * 1e6))
+
+
+if __name__ == '__main__':
+    benchmark()
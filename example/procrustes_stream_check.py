@@ -0,0 +1,47 @@
+"""
+Checks that `procrustes_stream` gives the same filtered rotations however a take is chunked, the
+smoothing state carries over between chunks. Runs outside of Maya:
+
+    python example/procrustes_stream_check.py
+"""
+
+import numpy as np
+
+from hbtools.numpy.procrustus import procrustes_stream
+
+
+def _take(frames, markers, seed=0):
+    rng = np.random.RandomState(seed)
+    neutral = rng.normal(size=(markers, 3))
+    # A slow spin about a wobbling axis, with noisy markers.
+    angles = np.linspace(0., 4. * np.pi, frames)
+    axes = np.stack((np.sin(0.1 * angles), np.cos(0.1 * angles), np.ones(frames)), axis=1)
+    axes /= np.sqrt((axes**2.).sum(1))[:, np.newaxis]
+    take = np.empty((frames, markers, 3))
+    for i in range(frames):
+        k = np.array([[0., -axes[i, 2], axes[i, 1]], [axes[i, 2], 0., -axes[i, 0]], [-axes[i, 1], axes[i, 0], 0.]])
+        rotation = np.eye(3) + np.sin(angles[i]) * k + (1. - np.cos(angles[i])) * k.dot(k)
+        take[i] = neutral.dot(rotation.T)
+    return neutral, take + 0.05 * rng.normal(size=take.shape)
+
+
+def _rotations(neutral, take, chunk_size, **kwargs):
+    chunks = (take[i:i + chunk_size] for i in range(0, len(take), chunk_size))
+    return np.concatenate([tform['rotation'] for _, _, tform in procrustes_stream(neutral, chunks, **kwargs)])
+
+
+def check(frames=500, markers=30):
+    neutral, take = _take(frames, markers)
+    for reflection in ('best', True):
+        for smoothing in (0., 0.5, 0.9):
+            whole = _rotations(neutral, take, frames, reflection=reflection, smoothing=smoothing)
+            for chunk_size in (1, 7, 128):
+                chunked = _rotations(neutral, take, chunk_size, reflection=reflection, smoothing=smoothing)
+                difference = np.abs(chunked - whole).max()
+                print("reflection={:<5} smoothing={:.1f} chunk_size={:<4} max difference: {:.2e}".format(
+                    str(reflection), smoothing, chunk_size, difference))
+                assert difference < 1e-12, "Chunked rotations differ from the whole take"
+
+
+if __name__ == '__main__':
+    check()
@@ -1,14 +1,17 @@
 import numpy as np
+import scipy.sparse
 import maya.cmds as cmds
-import maya.OpenMaya as OpenMaya
-import maya.OpenMayaAnim as OpenMayaAnim
+import maya.api.OpenMaya as OpenMaya2
+
+import hbtools.numpy.blendshapes as blendshapes
+import hbtools.numpy.column_analysis as column_analysis
 
 """
 Collection of methods to gather Maya data into Numpy structures.
 """
 
 
-def get_blendshape_mat(bs_node_name, indices=None, include_z=True, apply_vertex_weight_map=True):
+def get_blendshape_mat(bs_node_name, indices=None, include_z=True, apply_vertex_weight_map=True, sparse=None):
     """ A mat of a blendshape node, only collects the vertices that are in indices or all
     Returns a mat of the form:
     X X X...
@@ -17,36 +20,24 @@ def get_blendshape_mat(bs_node_name, indices=None, include_z=True, apply_vertex_
     X X X
     Y Y Y
     ...
+    sparse "csc" or "csr" returns a scipy.sparse matrix of that format that only stores the moved vertices
+    of each target, instead of a dense array.
+    The points and indices of every target are read into numpy arrays in one go and scattered into the
+    matrix with fancy indexing, see hbtools.numpy.blendshapes.
     """
-    bs_node_obj = OpenMaya.MObject()
-    sel = OpenMaya.MSelectionList()
-    sel.add(bs_node_name, 0)
-    sel.getDependNode(0, bs_node_obj)
-
-    bs_node = OpenMaya.MFnDependencyNode(bs_node_obj)
-    input_target_group_plug = bs_node.findPlug('inputTarget').elementByPhysicalIndex(0).child(0)
-
-    output_mesh = bs_node.findPlug('outputGeometry').elementByPhysicalIndex(0).asMObject()
-    output_mesh = OpenMaya.MFnMesh(output_mesh)
-    vertex_count = output_mesh.numVertices()
-
-    rows = -1
-    if indices is None:
-        if include_z:
-            rows = 3 * vertex_count
-        else:
-            rows = 2 * vertex_count
-    else:
-        if include_z:
-            rows = 3 * len(indices)
-        else:
-            rows = 2 * len(indices)
+    sel = OpenMaya2.MSelectionList()
+    sel.add(bs_node_name)
+    bs_node = OpenMaya2.MFnDependencyNode(sel.getDependNode(0))
+    input_target_group_plug = bs_node.findPlug('inputTarget', False).elementByPhysicalIndex(0).child(0)
+
+    output_mesh = bs_node.findPlug('outputGeometry', False).elementByPhysicalIndex(0).asMObject()
+    vertex_count = OpenMaya2.MFnMesh(output_mesh).numVertices
 
-    matrix = np.zeros((rows, input_target_group_plug.numElements()))
-    target_group_indices = OpenMaya.MIntArray()
-    input_target_group_plug.getExistingArrayAttributeIndices(target_group_indices)
-    # print "Iterating over {} input targets".format(input_target_group_plug.numElements())
-    # print "Iterating over {}".format(target_group_indices)
+    dimensions = 3 if include_z else 2
+    rows = dimensions * (vertex_count if indices is None else len(indices))
+    target_group_indices = input_target_group_plug.getExistingArrayAttributeIndices()
+    # Row of every vertex, -1 for the vertices that are not in indices.
+    lookup = None if indices is None else blendshapes.row_lookup(indices, vertex_count)
 
     """
     Note: Physical vs Logical index
@@ -54,137 +45,174 @@ def get_blendshape_mat(bs_node_name, indices=None, include_z=True, apply_vertex_
     Logical index: list reduced to only the indexes it has, access by its TRUE index, visible in node editor
     """
 
-    column_counter = 0
+    columns = []
     for i in target_group_indices:
-        input_target_6000_plug = input_target_group_plug.elementByLogicalIndex(i).child(0).elementByPhysicalIndex(0)
-
-        # Vertices / Points
-        input_points_target = input_target_6000_plug.child(3).asMObject()
-        fn_points = OpenMaya.MFnPointArrayData(input_points_target)
-        target_points = OpenMaya.MPointArray()
-        fn_points.copyTo(target_points)
-
-        # Indices
-        input_components_target = input_target_6000_plug.child(4).asMObject()
-        component_list = OpenMaya.MFnComponentListData(input_components_target)[0]
-        fn_index = OpenMaya.MFnSingleIndexedComponent(component_list)
-        target_indices = OpenMaya.MIntArray()
-        fn_index.getElements(target_indices)
-
-        if target_indices.length() == target_points.length():
-            # Weight map.
-            has_vertex_weight_map = False
-            if apply_vertex_weight_map:
-                target_vertex_weight_plug = input_target_group_plug.elementByLogicalIndex(i).child(1)
-                if target_vertex_weight_plug.numElements() > 0:
-                    weight_indices = OpenMaya.MIntArray()
-                    target_vertex_weight_plug.getExistingArrayAttributeIndices(weight_indices)
-                    index_counter = 0
-                    has_vertex_weight_map = True
-
-            # print "Processing {}, has weight map = {}".format(i, has_vertex_weight_map)
-
-            for j in range(target_indices.length()):
-                try:
-                    # Index in matrix.
-                    m_index = -1
-                    if indices is None:
-                        m_index = target_indices[j]
-                    else:
-                        # Follow ordering of indices.
-                        m_index = indices.index(target_indices[j])
-
-                    # Weight map value.
-                    weight_val = 1.0
-                    if has_vertex_weight_map:
-                        # Abusing fact that target_indices and weight_indices should be ordered.
-                        for k in range(index_counter, target_vertex_weight_plug.numElements()):
-                            if weight_indices[k] == target_indices[j]:
-                                weight_val = input_target_group_plug.elementByLogicalIndex(i).child(1).elementByLogicalIndex(target_indices[j]).asFloat()
-                                # weight_val = cmds.getAttr(bs_node_name+".inputTarget[0].inputTargetGroup[{}].targetWeights[{}]".format(i, target_indices[j]))
-                                index_counter = k + 1
-                            elif weight_indices[k] < target_indices[j]:
-                                pass
-                            else:
-                                break
-                        else:
-                            # We either hit a value or iterate over the entire weight_indices once.
-                            index_counter = target_vertex_weight_plug.numElements() + 1
-
-                    # Set values.
-                    if include_z:
-                        matrix[3 * m_index, column_counter] = target_points[j].x * weight_val
-                        matrix[3 * m_index + 1, column_counter] = target_points[j].y * weight_val
-                        matrix[3 * m_index + 2, column_counter] = target_points[j].z * weight_val
-                    else:
-                        matrix[2 * m_index, column_counter] = target_points[j].x * weight_val
-                        matrix[2 * m_index + 1, column_counter] = target_points[j].y * weight_val
-
-                except ValueError, e:
-                    # print "Value error in {}".format(i)
-                    # print e
-                    # Should only happen when target_indices[j] is not in indices
-                    pass
-
-            column_counter = column_counter + 1
-        else:
-            print "Faulty blendshape in {}, aborting".format(i)
+        target_group_plug = input_target_group_plug.elementByLogicalIndex(i)
+        input_target_6000_plug = target_group_plug.child(0).elementByPhysicalIndex(0)
+
+        target_points, target_indices = _get_target_arrays(input_target_6000_plug)
+        if len(target_indices) != len(target_points):
+            print("Faulty blendshape in {}, aborting".format(i))
             return None
 
-    return matrix, target_group_indices
+        # Follow ordering of indices.
+        target_rows = target_indices if lookup is None else lookup[target_indices]
 
+        # Weight map.
+        weights = None
+        if apply_vertex_weight_map:
+            weight_map = get_target_weight_map(bs_node_name, i, vertex_count)
+            if weight_map is not None:
+                weights = weight_map[target_indices]
+
+        columns.append(blendshapes.target_entries(target_points, target_rows, weights=weights, include_z=include_z))
+
+    return blendshapes.assemble_matrix(columns, rows, sparse=sparse), target_group_indices
+
+
+def _get_target_arrays(input_target_item_plug):
+    """ The (n, 3) deltas and (n,) vertex indices of an inputTargetItem plug as numpy arrays. """
+    points_data = input_target_item_plug.child(3).asMObject()
+    if points_data.isNull():
+        return np.empty((0, 3)), np.empty(0, dtype=int)
+    target_points = OpenMaya2.MFnPointArrayData(points_data).array()
+    # MPoints are (x, y, z, w).
+    target_points = np.array(target_points, dtype=np.float64).reshape(-1, 4)[:, :3]
+
+    component_list = OpenMaya2.MFnComponentListData(input_target_item_plug.child(4).asMObject())
+    if component_list.length() == 0:
+        return target_points, np.empty(0, dtype=int)
+    target_indices = OpenMaya2.MFnSingleIndexedComponent(component_list.get(0)).getElements()
+    return target_points, np.array(target_indices, dtype=int)
+
+
+# Painted Target Weights #
 
-def get_vtx_mat(shape_node_name, indices=None, include_z=True, include_index=False):
-    """ Returns a list of m_index;x;y;z strings """
 
-    vtx_index_list = cmds.getAttr(shape_node_name + ".vrts", multiIndices=True)
+_weight_maps = {}           # (blendshape node key, target index): (vertex_count,) painted weights or None.
+_weight_map_callbacks = {}  # blendshape node key: ids of the callbacks that drop its weight maps.
+_scene_callbacks = []       # ids of the callbacks that drop all weight maps on file new and open.
 
-    vtx_world_points = None
-    rows = 0
-    if indices is not None:
-        rows = len(indices)
+
+def get_target_weight_map(bs_node_name, target_index, vertex_count):
+    """ The painted targetWeights of a target as a dense (vertex_count,) array, None if nothing is painted.
+    Vertices without a painted value weigh 1.0. Maps are read with one getAttr over the whole range and
+    cached until a targetWeights value of the blendshape node changes, so reloading doesn't read them again.
+    The cache follows the node itself, not its name, and is dropped when the node is deleted or another
+    scene is opened.
+    """
+    node = _get_depend_node(bs_node_name)
+    key = (_node_key(node), target_index)
+    if key not in _weight_maps:
+        _watch_weight_maps(node)
+        _weight_maps[key] = _read_weight_map(bs_node_name, target_index, vertex_count)
+    return _weight_maps[key]
+
+
+def clear_weight_map_cache(bs_node_name=None):
+    """ Drops the cached weight maps and their callbacks, of one blendshape node or all of them. """
+    if bs_node_name is None:
+        _forget_weight_maps()
+        while _scene_callbacks:
+            OpenMaya2.MMessage.removeCallback(_scene_callbacks.pop())
     else:
-        rows = len(vtx_index_list)
+        _forget_weight_maps(_node_key(_get_depend_node(bs_node_name)))
 
-    if include_index:
-        if include_z:
-            vtx_world_points = np.zeros((rows, 4))
-        else:
-            vtx_world_points = np.zeros((rows, 3))
+
+def _read_weight_map(bs_node_name, target_index, vertex_count):
+    attribute = "{}.inputTarget[0].inputTargetGroup[{}].targetWeights".format(bs_node_name, target_index)
+    painted = cmds.getAttr(attribute, multiIndices=True)
+    if not painted:
+        return None
+
+    painted = np.array(painted, dtype=int)
+    painted = painted[painted < vertex_count]
+    weights = np.ones(vertex_count)
+    if not len(painted):
+        return weights
+
+    last = painted.max()
+    values = np.atleast_1d(np.array(cmds.getAttr("{}[0:{}]".format(attribute, last)), dtype=np.float64)).ravel()
+    if len(values) == last + 1:
+        weights[:last + 1] = values
     else:
-        if include_z:
-            vtx_world_points = np.zeros((rows, 3))
-        else:
-            vtx_world_points = np.zeros((rows, 2))
-
-    row_counter = 0
-    for i in vtx_index_list:
-        if indices is None:
-            position = cmds.xform(str(shape_node_name) + ".pnts[" + str(i) + "]", query=True, translation=True, worldSpace=True)
-            vtx_world_points[row_counter, 0] = position[0]
-            vtx_world_points[row_counter, 1] = position[1]
-            if include_z:
-                vtx_world_points[row_counter, 2] = position[2]
-                if include_index:
-                    vtx_world_points[row_counter, 3] = i
-            else:
-                if include_index:
-                    vtx_world_points[row_counter, 2] = i
-            row_counter = row_counter + 1
-        else:
-            if i in indices:
-                position = cmds.xform(str(shape_node_name) + ".pnts[" + str(i) + "]", query=True, translation=True, worldSpace=True)
-                vtx_world_points[row_counter, 0] = position[0]
-                vtx_world_points[row_counter, 1] = position[1]
-                if include_z:
-                    vtx_world_points[row_counter, 2] = position[2]
-                    if include_index:
-                        vtx_world_points[row_counter, 3] = i
-                else:
-                    if include_index:
-                        vtx_world_points[row_counter, 2] = i
-                row_counter = row_counter + 1
+        # Only the painted elements of the range came back.
+        weights[painted] = values[:len(painted)]
+    return weights
+
+
+def _get_depend_node(node_name):
+    sel = OpenMaya2.MSelectionList()
+    sel.add(node_name)
+    return sel.getDependNode(0)
+
+
+def _node_key(node):
+    # Names repeat across scenes ("blendShape1"), the handle identifies the node itself.
+    return OpenMaya2.MObjectHandle(node).hashCode()
+
 
+def _watch_weight_maps(node):
+    key = _node_key(node)
+    if key in _weight_map_callbacks:
+        return
+    if not _scene_callbacks:
+        for message in (OpenMaya2.MSceneMessage.kAfterNew, OpenMaya2.MSceneMessage.kAfterOpen):
+            _scene_callbacks.append(OpenMaya2.MSceneMessage.addCallback(message, _on_scene_changed))
+    _weight_map_callbacks[key] = [
+        OpenMaya2.MNodeMessage.addAttributeChangedCallback(node, _on_attribute_changed, key),
+        OpenMaya2.MNodeMessage.addNodePreRemovalCallback(node, _on_node_removed, key),
+    ]
+
+
+def _on_attribute_changed(message, plug, other_plug, key):
+    if "targetWeights" in plug.partialName(useFullAttributePath=True, useLongNames=True):
+        _drop_weight_maps(key)
+
+
+def _on_node_removed(node, key):
+    _forget_weight_maps(key)
+
+
+def _on_scene_changed(client_data=None):
+    _forget_weight_maps()
+
+
+def _forget_weight_maps(key=None):
+    """ Drops the weight maps and node callbacks of one node key or all of them. """
+    for node in list(_weight_map_callbacks):
+        if key is None or node == key:
+            for callback_id in _weight_map_callbacks.pop(node):
+                OpenMaya2.MMessage.removeCallback(callback_id)
+    _drop_weight_maps(key)
+
+
+def _drop_weight_maps(key=None):
+    for map_key in list(_weight_maps):
+        if key is None or map_key[0] == key:
+            del _weight_maps[map_key]
+
+
+def get_points(shape_node_name, world_space=True):
+    """ The (vertices, 3) positions of all vertices of a mesh, read with a single MFnMesh.getPoints call """
+    sel = OpenMaya2.MSelectionList()
+    sel.add(shape_node_name)
+    space = OpenMaya2.MSpace.kWorld if world_space else OpenMaya2.MSpace.kObject
+    points = OpenMaya2.MFnMesh(sel.getDagPath(0)).getPoints(space)
+    # MPoints are (x, y, z, w).
+    return np.array(points, dtype=np.float64).reshape(-1, 4)[:, :3]
+
+
+def get_vtx_mat(shape_node_name, indices=None, include_z=True, include_index=False):
+    """ Returns a mat of x;y;z world space rows (x;y without z), followed by the vertex index with
+    include_index, of all vertices or the ones in indices in the order of indices
+    """
+    points = get_points(shape_node_name)
+    vertex_indices = np.arange(len(points)) if indices is None else np.asarray(indices, dtype=int).ravel()
+
+    vtx_world_points = points[vertex_indices, :3 if include_z else 2]
+    if include_index:
+        vtx_world_points = np.hstack([vtx_world_points, vertex_indices[:, np.newaxis]])
     return vtx_world_points
 
 
@@ -192,15 +220,22 @@ def get_vtx_mat(shape_node_name, indices=None, include_z=True, include_index=Fal
 
 
 def get_zero_columns(matrix):
-    """ Returns a list of the columns which are all 0 """
-    rows = matrix.shape[0]
-    columns = matrix.shape[1]
-
-    result = []
-    for j in range(columns):
-        is_zero_column = True
-        for i in range(rows):
-            is_zero_column = is_zero_column and matrix[i, j] == 0.0
-        result.append(is_zero_column)
-
-    return result
+    """ Returns a list of the columns which are all 0, matrix may be dense or scipy.sparse """
+    return column_analysis.get_zero_columns(matrix).tolist()
+
+
+def filter_zero_columns(matrix, tol=0.0, redundant=False):
+    """ Returns the matrix without its zero columns and the original index of every kept column, see
+    hbtools.numpy.column_analysis.filter_zero_columns for tol and redundant
+    """
+    return column_analysis.filter_zero_columns(matrix, tol=tol, redundant=redundant)
+
+
+def get_matrix_memory(matrix):
+    """ Returns the bytes used by a dense or scipy.sparse matrix """
+    if matrix is None:
+        return 0
+    if scipy.sparse.issparse(matrix):
+        return sum(getattr(matrix, name).nbytes for name in ("data", "indices", "indptr", "row", "col")
+                   if hasattr(matrix, name))
+    return np.asarray(matrix).nbytes
@@ -1,16 +1,12 @@
 import maya.cmds as cmds
 import maya.OpenMaya as OpenMaya
 
+import hbtools.maya.maya2numpy as m2n
 
-def get_vtx_position(shape_node):
-    vtx_world_positions = []  # [ [index, x, y, z], ... ]
-    vtx_index_list = cmds.getAttr(shape_node + ".vrts", multiIndices=True)
-
-    for i in vtx_index_list:
-        point_position = cmds.xform(str(shape_node) + ".pnts[" + str(i) + "]", query=True, translation=True, worldSpace=True)
-        vtx_world_positions.append(point_position)
 
-    return vtx_world_positions
+def get_vtx_position(shape_node):
+    """ World space [x, y, z] of every vertex, see maya2numpy.get_points. """
+    return m2n.get_points(shape_node).tolist()
 
 
 def set_blendshape_weights(blendshape_node, weights, clamp=True):
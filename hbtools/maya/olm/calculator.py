@@ -1,86 +1,295 @@
 import os
 import sys
 import json
+import numpy as np
 import maya.cmds as cmds
 
-import scipy.optimize as sp
+import hbtools.numpy.solvers as solvers
+import hbtools.numpy.compression as compression
 import hbtools.maya.mesh_utils as mu
 import hbtools.maya.maya2numpy as m2n
 
 
 class BlendshapeCalculator(object):
-    def __init__(self, blendshape, output_mesh, z=True, debug=False):
+    _SOLVERS = {"nnls": solvers.NNLSSolver,         # scipy nnls on the full matrix per solve.
+                "gram": solvers.GramNNLSSolver,     # Cached Gram matrix and factorization.
+                "bounded": solvers.BoundedLSQSolver,  # Weights within [lower, upper], default [0, 1].
+                "regularized": solvers.RegularizedSolver,  # Ridge (l2) and sparsity (l1) penalties.
+                "temporal": solvers.TemporalSolver}  # Smooth weight curves in [0, 1], solved jointly.
+
+    def __init__(self, blendshape, output_mesh, z=True, debug=False, solver="nnls", sparse=None):
         self._debug = debug             # Print debug statements.
         self._z = z                     # Use z-axis for calculation.
+        self._sparse = sparse           # None for dense matrices, else the scipy.sparse format, "csc" or "csr".
+        self._solver = self._create_solver(solver)
         # Scene data
         self._output_mesh = output_mesh
         self._blendshape_node = blendshape
         # Indices
         self._indices = []
+        # Full mesh data, the rows of the selected vertices are taken from these.
+        self._mesh_blendshape_mat = None    # (3 * vertices, targets) csr, xyz rows of every vertex.
+        self._mesh_neutral = None           # (vertices, 3) world space positions.
         # Raw data
         self._blendshape_mat = None      # Raw Blendshape Matrix
         self._blendshape_indices = None  # Target Indices List
         self._neutral_mesh = None
 
         # Calculation data
-        self._removed_cols = None
+        self._filtered_blendshape = None
+        self._kept_cols = None              # Original column index of every filtered column.
+        self._weight_bounds = (0.0, 1.0)    # Per target lower and upper bounds, for the bounded solver.
+
+        # Low-rank compression
+        self._compression_settings = None   # (energy, rank, path) of set_compression.
+        self._compression = None            # CompressedBasis of the full mesh matrix.
+        self._projection = None             # Q, the solver sees C x = Q^T b, see CompressedBasis.reduce.
 
         self.reload()
 
     # Data loading #
 
     def reload(self):
-        """ Reloads the raw geometry data from Maya. """
+        """ Reloads the raw geometry data of the whole mesh from Maya. """
         self.load_neutral_mesh()
         self.load_blendshape()
 
     def load_blendshape(self):
-        """ Inits the blendshape matrix. """
-        blendshape, indices = m2n.get_blendshape_mat(self._blendshape_node, indices=self._indices, include_z=self._z)
-        self._blendshape_mat = blendshape
+        """ Inits the blendshape matrix of the whole mesh and selects the rows of the vertex indices.
+
+        The whole mesh is kept as csr whatever the sparse setting, targets only move part of the mesh and
+        dense it would take 24 bytes per vertex and target, 360 MB for 50k vertices and 300 targets.
+        Without sparse only the selected rows of the vertex indices are made dense.
+        """
+        blendshape, indices = m2n.get_blendshape_mat(self._blendshape_node, indices=None, include_z=True,
+                                                     sparse="csr")
+        self._mesh_blendshape_mat = blendshape
         self._blendshape_indices = indices
-        self._filter_blendshape()
+        if self._compression_settings is not None:
+            self._compress()
+        self._select_blendshape()
+
+        if self._debug:
+            sys.stdout.write("Memory: {} \n".format(self.memory_usage()))
 
     def load_neutral_mesh(self):
-        """ Inits the neutral matrix. """
+        """ Inits the neutral positions of the whole mesh and selects those of the vertex indices. """
         mu.set_blendshape_weights_to(self._blendshape_node, 0.0)
-        self._neutral_mesh = m2n.get_vtx_mat(self._output_mesh, indices=self._indices, include_z=self._z)
-        self._neutral_mesh = self._neutral_mesh.flatten()
+        self._mesh_neutral = m2n.get_points(self._output_mesh)
+        self._select_neutral_mesh()
+
+    def _select_blendshape(self):
+        self._blendshape_mat = self._select_rows(self._indices)
+        self._filter_blendshape()
+
+    def _select_neutral_mesh(self):
+        self._neutral_mesh = self._mesh_neutral[self._indices, :self._dimensions()].flatten()
         if self._debug:
             message = "Neutral Shape: {}".format(self._neutral_mesh.shape)
             sys.stdout.write(message)
-        # TODO; add filtering method to circumvent changing weights reloading the entire mesh.
 
-    def _filter_blendshape(self):
-        a, b = m2n.filter_zero_columns(self._blendshape_mat, debug=True)
-        self._filtered_blendshape = a
-        self._removed_cols = b
+    def _update_selection(self):
+        """ Brings the selected rows up to date with the vertex indices, only extracts a mesh that isn't
+        cached yet.
+        """
+        if self._mesh_blendshape_mat is None or self._mesh_neutral is None:
+            self.reload()
+        else:
+            self._select_neutral_mesh()
+            self._select_blendshape()
+
+    def _dimensions(self):
+        return 3 if self._z else 2
+
+    def _rows(self, indices):
+        """ Rows of the vertex indices in the full mesh blendshape matrix, in the order of indices. """
+        indices = np.asarray(indices, dtype=int).reshape(-1, 1)
+        return (3 * indices + np.arange(self._dimensions())).ravel()
+
+    def _select_rows(self, indices):
+        """ The blendshape matrix rows of the vertex indices, in the sparse format if sparse. """
+        matrix = self._mesh_blendshape_mat[self._rows(indices)]
+        if self._sparse is None:
+            return matrix.toarray()
+        return matrix.asformat(self._sparse)
+
+    def memory_usage(self):
+        """ Bytes used by the cached matrices, by name. """
+        gram = getattr(self._solver, "_gram", None)
+        return {"mesh_blendshape": m2n.get_matrix_memory(self._mesh_blendshape_mat),
+                "mesh_neutral": m2n.get_matrix_memory(self._mesh_neutral),
+                "blendshape": m2n.get_matrix_memory(self._blendshape_mat),
+                "filtered_blendshape": m2n.get_matrix_memory(self._filtered_blendshape),
+                "gram": m2n.get_matrix_memory(gram)}
+
+    def _filter_blendshape(self, added=None, removed=None):
+        """ Filters the zero columns and prepares the solver. When only the added and removed rows changed
+        and the same columns survive, the solver caches are updated with those rows.
+        """
+        kept_cols = self._kept_cols
+        self._filtered_blendshape, self._kept_cols = m2n.filter_zero_columns(self._blendshape_mat)
 
         if self._debug:
-            sys.stdout.write("Removed Columns: {} \n".format(self._removed_cols))
+            removed_cols = np.setdiff1d(np.arange(self._blendshape_mat.shape[1]), self._kept_cols)
+            sys.stdout.write("Removed Columns: {} \n".format(removed_cols.tolist()))
             sys.stdout.write("Blendshape Shape: ".ljust(20, " ") + str(self._blendshape_mat.shape) + "\n")
             sys.stdout.write("Filtered Shape: ".ljust(20, " ") + str(self._filtered_blendshape.shape) + "\n")
 
+        if (added is None and removed is None) or self._compression is not None or \
+                not np.array_equal(kept_cols, self._kept_cols):
+            self._prepare_solver()
+        else:
+            if added is not None:
+                added = added[:, self._kept_cols]
+            if removed is not None:
+                removed = removed[:, self._kept_cols]
+            solvers.update_rows(self._solver, self._filtered_blendshape, added=added, removed=removed)
+
+    def _invalidate(self):
+        """ Drops the selected matrix and solver caches, the next calculation selects them again from
+        the cached mesh.
+        """
+        self._filtered_blendshape = None
+        self._solver.invalidate()
+
+    # Solver #
+
+    def _create_solver(self, name, **options):
+        try:
+            return self._SOLVERS[name](**options)
+        except KeyError:
+            raise ValueError("Unknown solver {}, expected one of {}".format(name, sorted(self._SOLVERS)))
+
+    def set_solver(self, name, **options):
+        """ Switches the solver backend, see _SOLVERS, options are passed on to the solver. """
+        self._solver = self._create_solver(name, **options)
+        if self._filtered_blendshape is not None:
+            self._prepare_solver()
+
+    def set_weight_bounds(self, lower=0.0, upper=1.0):
+        """ Weight bounds of the bounded solvers, scalars or one value per blendshape target. """
+        self._weight_bounds = (lower, upper)
+        if self._filtered_blendshape is not None:
+            self._prepare_solver()
+
+    def _prepare_solver(self):
+        if hasattr(self._solver, "set_bounds"):
+            lower, upper = [np.asarray(bound, dtype=float) for bound in self._weight_bounds]
+            if lower.ndim:
+                lower = lower[self._kept_cols]
+            if upper.ndim:
+                upper = upper[self._kept_cols]
+            self._solver.set_bounds(lower, upper)
+
+        if self._compression is None:
+            self._projection = None
+            self._solver.prepare(self._filtered_blendshape)
+        else:
+            self._projection, matrix = self._compression.reduce(self._rows(self._indices), self._kept_cols)
+            self._solver.prepare(matrix)
+
+    # Compression #
+
+    def set_compression(self, energy=0.999, rank=None, path=None):
+        """ Solves with a truncated SVD of the blendshape matrix, see hbtools.numpy.compression.
+
+        Keeps the given rank, or the components holding the energy fraction. The solvers then see r
+        rows instead of 3 * markers and reconstruct_deltas uses r components instead of all targets. With
+        path the compression is saved to that .npz file and loaded from it again while the rig and
+        settings are unchanged.
+        """
+        self._compression_settings = (energy, rank, path)
+        if self._mesh_blendshape_mat is not None:
+            self._compress()
+            if self._filtered_blendshape is not None:
+                self._prepare_solver()
+
+    def clear_compression(self):
+        self._compression_settings = None
+        self._compression = None
+        if self._filtered_blendshape is not None:
+            self._prepare_solver()
+
+    def compression_error(self):
+        """ The error the compression introduces, see CompressedBasis.error, None without compression. """
+        if self._compression is None:
+            return None
+        return self._compression.error(self._mesh_blendshape_mat, rows=self._rows(self._indices))
+
+    def _compress(self):
+        energy, rank, path = self._compression_settings
+        key = compression.matrix_key(self._mesh_blendshape_mat, energy=energy, rank=rank)
+        basis = None if path is None else compression.load_basis(path, key)
+        if basis is None:
+            basis = compression.compress_basis(self._mesh_blendshape_mat, energy=energy, rank=rank)
+            if path is not None:
+                basis.save(path, key)
+        self._compression = basis
+
+        if self._debug:
+            sys.stdout.write("Compressed to rank {} of {}, errors {} \n".format(
+                basis.rank, self._mesh_blendshape_mat.shape[1], self.compression_error()))
+
+    def _project_targets(self, targets):
+        """ Targets as the solver sees them, projected onto the compressed rows when compressed. """
+        if self._projection is None:
+            return targets
+        return np.asarray(targets, dtype=float).dot(self._projection)
+
+    def reconstruct_deltas(self, weights):
+        """ The (vertices, 3) offsets of the whole mesh for (targets,) weights, (F, vertices, 3) for
+        (F, targets) weights. Runs through the compressed components when compressed.
+        """
+        weights = np.asarray(weights, dtype=float)
+        if self._compression is not None:
+            deltas = self._compression.reconstruct(weights)
+        else:
+            deltas = np.asarray(self._mesh_blendshape_mat.dot(weights.T)).T
+        return deltas.reshape(weights.shape[:-1] + (-1, 3))
+
     # Vertex Indices #
 
     def set_vertex_indices(self, indices):
-        """ Loads the indices to be used. """
-        self._indices = indices
+        """ Loads the indices to be used, their rows are selected from the cached mesh on the next
+        calculation.
+        """
+        self._indices = list(indices)
+        self._invalidate()
 
     def add_index(self, index, reload_=True):
+        """ Adds the rows of a vertex from the cached mesh. With reload_ the matrices and the solver are
+        updated right away, the solver caches with just the new rows, else on the next calculation.
+        """
         self._indices.append(index)
         self._indices = sorted(self._indices)
-        if reload_:
-            self.reload()
+        if reload_ and self._filtered_blendshape is not None:
+            self._select_neutral_mesh()
+            self._blendshape_mat = self._select_rows(self._indices)
+            self._filter_blendshape(added=self._select_rows([index]))
+        elif reload_:
+            self._update_selection()
+        else:
+            self._invalidate()
 
-    def remove_index(self, index):
+    def remove_index(self, index, reload_=True):
+        """ Removes the rows of a vertex, see add_index. """
         try:
             self._indices.remove(index)
         except ValueError, e:
-            pass
+            return
+
+        if reload_ and self._filtered_blendshape is not None:
+            self._select_neutral_mesh()
+            self._blendshape_mat = self._select_rows(self._indices)
+            self._filter_blendshape(removed=self._select_rows([index]))
+        elif reload_:
+            self._update_selection()
+        else:
+            self._invalidate()
 
     def clear_vertex_indices(self):
         self._indices = []
+        self._invalidate()
 
     # Calculations #
 
@@ -88,12 +297,11 @@ class BlendshapeCalculator(object):
         # diff = target_points - self._neutral_mesh
         diff = target_points  # TODO; check if true.
 
-        weights, error = sp.nnls(self._filtered_blendshape, diff)
-        weights = [wi for wi in weights]
+        if self._filtered_blendshape is None:
+            self._update_selection()
 
-        # Insert zero columns back in
-        for i in range(len(self._removed_cols)):
-            weights.insert(self._removed_cols[i] + i, 0)
+        weights, error = self._solver.solve(self._project_targets(diff))
+        weights = self._expand_weights(weights).tolist()
 
         if self._debug:
             sys.stdout.write("Weights: {} \n".format(weights))
@@ -104,6 +312,74 @@ class BlendshapeCalculator(object):
 
         return weights
 
+    def solve_sequence(self, frames, warm_start=True, return_iterations=False, processes=None):
+        """ Solves an (F, 3 * markers) array of flattened frames without touching the scene.
+
+        Returns an (F, targets) weight array, plus the solver iterations per frame if return_iterations.
+        All frames share the prepared solver, the "gram" and "bounded" solvers project every frame onto
+        the targets with a single matrix product. With warm_start every frame starts from the previous
+        solution. With processes the frames are solved in chunks by that many worker processes sharing
+        the matrix through a memory map, see solvers.solve_sequence_parallel. The "temporal" solver
+        solves all frames as one system with smooth weight curves and can't be split up.
+        """
+        if processes is not None and isinstance(self._solver, solvers.TemporalSolver):
+            raise ValueError("The temporal solver solves all frames jointly, it can't run in processes")
+        if self._filtered_blendshape is None:
+            self._update_selection()
+
+        frames = self._project_targets(np.asarray(frames, dtype=float))
+        if processes is None:
+            weights, errors, iterations = self._solver.solve_sequence(frames, warm_start=warm_start)
+        else:
+            weights, errors, iterations = solvers.solve_sequence_parallel(self._solver, frames, processes=processes,
+                                                                          warm_start=warm_start)
+        weights = self._expand_weights(weights)
+
+        if self._debug:
+            sys.stdout.write("Solved {} frames, mean error {}, mean iterations {} \n".format(
+                len(weights), errors.mean(), iterations.mean()))
+
+        if return_iterations:
+            return weights, iterations
+        return weights
+
+    def solve_regularization_path(self, frames, l2=None, l1=None):
+        """ Solves an (F, 3 * markers) array of flattened frames for a sweep of l2 or l1 values.
+
+        Returns (L, F, targets) weights and (L, F) errors, one entry per given value, to tune the penalty
+        on a whole take. Needs the "regularized" solver, the penalty that is not swept is taken from it.
+        """
+        if not isinstance(self._solver, solvers.RegularizedSolver):
+            raise ValueError("The regularization path needs the regularized solver, see set_solver")
+        if self._filtered_blendshape is None:
+            self._update_selection()
+
+        frames = self._project_targets(np.asarray(frames, dtype=float))
+        weights, errors = self._solver.solve_path(frames, l2=l2, l1=l1)
+        return self._expand_weights(weights), errors
+
+    def solve_stream(self, chunks, lookahead=0):
+        """ Generator over the (n, targets) weights of streamed (n, 3 * markers) frame chunks.
+
+        Needs the "temporal" solver. Every frame is solved in a sliding window with the lookahead frames
+        after it and continues the curve of the frames before it, see solvers.TemporalSolver.solve_stream.
+        """
+        if not isinstance(self._solver, solvers.TemporalSolver):
+            raise ValueError("Streaming needs the temporal solver, see set_solver")
+        if self._filtered_blendshape is None:
+            self._update_selection()
+
+        chunks = (self._project_targets(chunk) for chunk in chunks)
+        for weights in self._solver.solve_stream(chunks, lookahead=lookahead):
+            yield self._expand_weights(weights)
+
+    def _expand_weights(self, weights):
+        """ Scatters filtered weights, (k,) or (F, k), back to all targets with zeros for removed columns. """
+        weights = np.asarray(weights)
+        expanded = np.zeros(weights.shape[:-1] + (self._blendshape_mat.shape[1],))
+        expanded[..., self._kept_cols] = weights
+        return expanded
+
 
 # Maya Scene Debug Helpers #
 
@@ -3,6 +3,8 @@ import maya.cmds as cmds
 import maya.OpenMaya as OpenMaya
 import maya.OpenMayaAnim as OpenMayaAnim
 
+import hbtools.maya.maya2numpy as m2n
+
 
 # Data Loading #
 
@@ -53,14 +55,8 @@ def basic_measure():
 
 
 def get_vtx_positions(shape_node):
-    vtx_world_positions = []  # [ [x, y, z], ... ]
-    vtx_index_list = cmds.getAttr(shape_node + ".vrts", multiIndices=True)
-
-    for i in vtx_index_list:
-        point_position = cmds.xform(str(shape_node) + ".pnts[" + str(i) + "]", query=True, translation=True, worldSpace=True)
-        vtx_world_positions.append(point_position)
-
-    return vtx_world_positions
+    """ World space [x, y, z] of every vertex, see maya2numpy.get_points. """
+    return m2n.get_points(shape_node).tolist()
 
 
 def set_blendshape_weights_array(bs_node_name, weights):
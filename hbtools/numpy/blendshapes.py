@@ -0,0 +1,69 @@
+"""
+Assembles blendshape matrices from the per target delta arrays read from a blendshape node.
+
+Every target becomes one column, the deltas of vertex v fill the rows of v's position in the matrix:
+
+    X X X...
+    Y Y Y
+    Z Z Z
+    X X X
+    ...
+
+Nothing here needs Maya, maya2numpy reads the arrays and hands them over.
+"""
+
+import numpy as np
+import scipy.sparse
+
+
+def row_lookup(indices, vertex_count):
+    """ The (vertex_count,) position of every vertex in indices, -1 for the vertices that are not in it.
+
+    A vertex listed twice maps to its first position, like list.index. Indices past vertex_count are
+    left out, no target moves them.
+    """
+    indices = np.asarray(indices, dtype=int).ravel()
+    positions = np.arange(len(indices))
+    inside = (indices >= 0) & (indices < vertex_count)
+
+    lookup = np.full(vertex_count, -1, dtype=int)
+    # Reversed so the first of repeated vertices is written last.
+    lookup[indices[inside][::-1]] = positions[inside][::-1]
+    return lookup
+
+
+def target_entries(points, rows, weights=None, include_z=True):
+    """ Matrix rows and values of the deltas of one target.
+
+    points are the (n, 3) deltas, rows the (n,) position of every delta's vertex in the matrix, negative
+    for vertices that are not in it. weights are the optional (n,) painted target weights. Returns the
+    row index and value of every matrix entry.
+    """
+    dimensions = 3 if include_z else 2
+    rows = np.asarray(rows, dtype=int)
+    keep = rows >= 0
+
+    values = np.asarray(points, dtype=np.float64).reshape(-1, 3)[keep, :dimensions]
+    if weights is not None:
+        values = values * np.asarray(weights, dtype=np.float64)[keep, np.newaxis]
+
+    entries = dimensions * rows[keep, np.newaxis] + np.arange(dimensions)
+    return entries.ravel(), values.ravel()
+
+
+def assemble_matrix(columns, rows, sparse=None):
+    """ The (rows, len(columns)) blendshape matrix of the target_entries of every column.
+
+    sparse None returns a dense array, "csc" or "csr" a scipy.sparse matrix of that format.
+    """
+    if sparse is None:
+        matrix = np.zeros((rows, len(columns)))
+        for column, (entries, values) in enumerate(columns):
+            matrix[entries, column] = values
+        return matrix
+
+    counts = [len(entries) for entries, _ in columns]
+    entries = np.concatenate([entries for entries, _ in columns] + [np.empty(0, dtype=int)])
+    values = np.concatenate([values for _, values in columns] + [np.empty(0)])
+    targets = np.repeat(np.arange(len(columns)), counts)
+    return scipy.sparse.coo_matrix((values, (entries, targets)), shape=(rows, len(columns))).asformat(sparse)
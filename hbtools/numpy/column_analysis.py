@@ -0,0 +1,77 @@
+"""
+Column analysis of blendshape matrices: targets that don't move the selected vertices, or move them
+like another target does. Such columns make the solve singular or just slower, filter_zero_columns
+drops them and returns the index map to scatter the weights of the kept columns back:
+
+    filtered, kept = filter_zero_columns(B)
+    weights = np.zeros(B.shape[1])
+    weights[kept] = solve(filtered, b)
+"""
+
+import numpy as np
+import scipy.sparse
+
+
+def get_zero_columns(matrix):
+    """ (k,) mask of the columns that are exactly 0, of a dense or scipy.sparse matrix. """
+    if scipy.sparse.issparse(matrix):
+        return np.asarray(abs(matrix).sum(axis=0)).ravel() == 0.
+    return ~np.asarray(matrix).any(axis=0)
+
+
+def analyze_columns(matrix, tol=0., collinear_tol=1e-10):
+    """ Finds the zero, near zero, duplicate and collinear columns of a dense or scipy.sparse (n, k) matrix.
+
+    All column relations come from one (k, k) Gram matrix, a sparse matrix is never made dense. Returns
+    a dict of (k,) arrays:
+
+        'norms'           the column norms.
+        'zero'            mask of the columns that are exactly 0.
+        'near_zero'       mask of the columns with a norm of at most tol, including the zero ones.
+        'collinear_with'  the first earlier column pointing the same way, the cosine of their angle is
+                          at least 1 - collinear_tol, else -1. Only the same direction counts, with
+                          non-negative weights an opposite column still adds to the solution space.
+        'duplicate_of'    the first earlier column that is collinear with and as long as the column,
+                          else -1.
+    """
+    gram = matrix.T.dot(matrix)
+    if scipy.sparse.issparse(gram):
+        gram = gram.toarray()
+    gram = np.asarray(gram, dtype=np.float64)
+
+    norms = np.sqrt(np.maximum(np.diag(gram), 0.))
+    zero = get_zero_columns(matrix)
+    near_zero = zero | (norms <= tol)
+
+    valid = ~near_zero
+    scale = np.where(valid, norms, 1.)
+    cosines = gram / scale[:, np.newaxis] / scale
+    # Earlier columns only, i < j.
+    collinear = np.triu(cosines >= 1. - collinear_tol, 1) & valid[:, np.newaxis] & valid
+    collinear_with = np.where(collinear.any(0), collinear.argmax(0), -1)
+
+    equal = np.abs(norms[:, np.newaxis] - norms) <= np.sqrt(collinear_tol) * np.maximum(norms[:, np.newaxis], norms)
+    duplicate = collinear & equal
+    duplicate_of = np.where(duplicate.any(0), duplicate.argmax(0), -1)
+
+    return {"norms": norms, "zero": zero, "near_zero": near_zero, "collinear_with": collinear_with,
+            "duplicate_of": duplicate_of}
+
+
+def filter_zero_columns(matrix, tol=0., redundant=False, collinear_tol=1e-10):
+    """ Drops the zero columns of a dense or scipy.sparse matrix, the near zero ones with tol > 0, and the
+    duplicate or collinear ones, which only split weight with an earlier column, with redundant.
+
+    Returns the filtered matrix, in the format of matrix, and the (k',) original index of every kept
+    column.
+    """
+    if tol == 0. and not redundant:
+        removed = get_zero_columns(matrix)
+    else:
+        analysis = analyze_columns(matrix, tol=tol, collinear_tol=collinear_tol)
+        removed = analysis["near_zero"]
+        if redundant:
+            removed = removed | (analysis["collinear_with"] >= 0)
+
+    kept = np.flatnonzero(~removed)
+    return matrix[:, kept], kept
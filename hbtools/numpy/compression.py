@@ -0,0 +1,139 @@
+"""
+Low-rank compression of a blendshape basis, B ~ U diag(s) V^T truncated to the strongest components.
+
+Solves and mesh reconstructions then run in the reduced space of r components instead of the full
+vertices or targets. The compression only depends on the rig, it is saved with a key of the matrix
+it was computed from and reused as long as that key matches:
+
+    basis = load_basis(path, matrix_key(B, energy=0.999))
+    if basis is None:
+        basis = compress_basis(B, energy=0.999)
+        basis.save(path, matrix_key(B, energy=0.999))
+"""
+
+import hashlib
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse
+
+
+def compress_basis(matrix, energy=0.999, rank=None):
+    """ Truncated SVD of a dense or scipy.sparse (n, k) matrix.
+
+    Keeps the given rank, or the fewest components holding the energy fraction of the squared
+    singular values. The SVD comes from the eigenvectors of the (k, k) Gram matrix, which never makes
+    a sparse matrix dense and is cheap for the few targets of a rig. Components weaker than the
+    precision of that route (about 1e-8 of the strongest) are always dropped.
+    """
+    gram = matrix.T.dot(matrix)
+    if scipy.sparse.issparse(gram):
+        gram = gram.toarray()
+    values, vectors = la.eigh(np.asarray(gram, dtype=np.float64))
+    values, vectors = np.maximum(values[::-1], 0.), vectors[:, ::-1]
+
+    total = values.sum()
+    strongest = values[0] if len(values) else 0.
+    valid = int((values > strongest * len(values) * np.finfo(float).eps).sum())
+    if rank is None:
+        if total > 0.:
+            rank = int(np.searchsorted(np.cumsum(values) / total, energy)) + 1
+        else:
+            rank = 0
+    rank = min(rank, valid)
+
+    singular_values = np.sqrt(values[:rank])
+    right = vectors[:, :rank]
+    left = np.asarray(matrix.dot(right)) / singular_values
+    retained = singular_values.dot(singular_values) / total if total > 0. else 1.
+    return CompressedBasis(left, singular_values, right, retained)
+
+
+class CompressedBasis(object):
+    """ Rank r approximation U diag(s) V^T of an (n, k) blendshape matrix, U (n, r) and V (k, r) with
+    orthonormal columns. energy is the retained fraction of the squared Frobenius norm.
+    """
+    def __init__(self, left, singular_values, right, energy):
+        self.left = left
+        self.singular_values = singular_values
+        self.right = right
+        self.energy = energy
+
+    @property
+    def rank(self):
+        return len(self.singular_values)
+
+    def coefficients(self, columns=None):
+        """ The (r, k) matrix diag(s) V^T mapping weights to components, optionally of some columns. """
+        right = self.right if columns is None else self.right[columns]
+        return self.singular_values[:, np.newaxis] * right.T
+
+    def reconstruct(self, weights, rows=None, columns=None):
+        """ B x of (k,) or (F, k) weights through the r components, optionally of some rows and columns. """
+        left = self.left if rows is None else self.left[rows]
+        return np.asarray(weights).dot(self.coefficients(columns).T).dot(left.T)
+
+    def reduce(self, rows=None, columns=None):
+        """ The reduced least squares system of some rows: Q (n, r) with orthonormal columns and C (r, k)
+        so that ||B x - b|| = ||C x - Q^T b|| plus the constant ||b - Q Q^T b||, B the approximation.
+        """
+        left = self.left if rows is None else self.left[rows]
+        q, r = la.qr(left, mode='economic')
+        return q, r.dot(self.coefficients(columns))
+
+    def error(self, matrix, rows=None, chunk_size=2**16):
+        """ The error of the approximation against the (n, k) matrix it came from.
+
+        Returns a dict with the 'relative' Frobenius error of the whole matrix, the 'relative_rows' error
+        of the given rows and the largest absolute error of any entry, 'max'. The matrix is compared in
+        chunks of rows, a sparse matrix is never made dense as a whole.
+        """
+        largest = 0.
+        for start in range(0, matrix.shape[0], chunk_size):
+            chunk = matrix[start:start + chunk_size]
+            chunk = chunk.toarray() if scipy.sparse.issparse(chunk) else np.asarray(chunk)
+            difference = chunk - self.left[start:start + chunk_size].dot(self.coefficients())
+            if difference.size:
+                largest = max(largest, np.abs(difference).max())
+
+        errors = {"relative": np.sqrt(max(1. - self.energy, 0.)), "max": largest}
+        if rows is not None:
+            selected = matrix[rows]
+            selected = selected.toarray() if scipy.sparse.issparse(selected) else np.asarray(selected)
+            norm = np.linalg.norm(selected)
+            difference = np.linalg.norm(selected - self.reconstruct(np.eye(matrix.shape[1]), rows=rows).T)
+            errors["relative_rows"] = difference / norm if norm > 0. else 0.
+        return errors
+
+    def save(self, path, key):
+        """ Saves the basis to an .npz file together with the key of its matrix, see matrix_key. """
+        np.savez(path, key=np.array(key), left=self.left, singular_values=self.singular_values,
+                 right=self.right, energy=self.energy)
+
+
+def load_basis(path, key):
+    """ The basis saved at path, None if there is none or it was computed for another key. """
+    try:
+        data = np.load(path)
+    except IOError:
+        return None
+
+    with data:
+        if str(data["key"]) != key:
+            return None
+        return CompressedBasis(data["left"], data["singular_values"], data["right"], float(data["energy"]))
+
+
+def matrix_key(matrix, energy=None, rank=None):
+    """ A hash of a dense or scipy.sparse matrix and the compression settings, identifies a rig version. """
+    digest = hashlib.sha1()
+    digest.update(repr((matrix.shape, energy, rank)).encode("utf-8"))
+    if scipy.sparse.issparse(matrix):
+        matrix = matrix.tocsr()
+        if not matrix.has_sorted_indices:
+            matrix = matrix.sorted_indices()
+        arrays = (matrix.data, matrix.indices, matrix.indptr)
+    else:
+        arrays = (matrix,)
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
@@ -0,0 +1,117 @@
+"""
+Pairwise Procrustes distances across a library of shapes, e.g. to find redundant blendshape targets.
+"""
+
+import multiprocessing
+import numpy as np
+
+from hbtools.numpy.procrustus import _as_weights, _centre
+
+
+def procrustes_distance_matrix(shapes, scaling=True, reflection='best', weights=None, max_memory=256 * 1024**2,
+                               processes=None):
+    """
+    The (K, K) matrix of Procrustes residuals d[i, j] = procrustes(shapes[i], shapes[j])[0].
+
+        d = procrustes_distance_matrix(targets, processes=8)
+
+    Every shape is centred and normalized once. The matrix is then filled in square tiles: one matrix
+    product gives all cross-covariances of a tile and one stacked SVD (singular values only) their
+    traces. Since the traces are symmetric only the upper triangle of tiles is computed.
+
+    Inputs:
+    ------------
+    shapes
+        (K, N, m) stack of shapes with corresponding points.
+
+    scaling, reflection, weights
+        see `procrustes`, weights are (N,) and shared by all shapes.
+
+    max_memory
+        approximate number of bytes of intermediate data per tile, sets the
+        tile size.
+
+    processes
+        number of worker processes to spread the tiles over, None computes
+        everything in this process. workers receive the normalized shapes
+        once on start up. note spawned workers (Windows, Maya) re-import the
+        calling module, call this from under a __main__ guard.
+
+    Outputs
+    ------------
+    d
+        (K, K) array of residuals, see `procrustes`. with scaling the matrix
+        is symmetric.
+
+    """
+
+    shapes = np.asarray(shapes, dtype=float)
+    if shapes.ndim != 3:
+        raise ValueError("Expected a (K, N, m) stack of shapes, got shape {}".format(shapes.shape))
+    K, n, m = shapes.shape
+
+    w = _as_weights(weights, n)
+    _, S0, ss, norm = _centre(shapes, w)
+    S0w = S0 if w is None else w * S0
+
+    # Cross-covariances, their product and the SVD work space per pair.
+    tile = max(1, int(np.sqrt(max_memory / (8. * (3 * m * m + 2 * m)))))
+    tiles = [(i, j) for i in range(0, K, tile) for j in range(i, K, tile)]
+
+    traces = np.empty((K, K))
+    if processes is None:
+        _init_worker(S0, S0w, reflection, tile)
+        results = (_trace_tile(t) for t in tiles)
+    else:
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(S0, S0w, reflection, tile))
+        results = pool.imap_unordered(_trace_tile, tiles)
+
+    try:
+        for i, j, block in results:
+            traces[i:i + block.shape[0], j:j + block.shape[1]] = block
+            traces[j:j + block.shape[1], i:i + block.shape[0]] = block.T
+    finally:
+        if processes is None:
+            _init_worker(None, None, None, None)
+        else:
+            pool.close()
+            pool.join()
+
+    if scaling:
+        return 1 - traces**2
+
+    return 1 + ss[np.newaxis] / ss[:, np.newaxis] - 2 * traces * norm[np.newaxis] / norm[:, np.newaxis]
+
+
+# Workers #
+
+
+_WORKER_DATA = {}
+
+
+def _init_worker(S0, S0w, reflection, tile):
+    _WORKER_DATA.update(S0=S0, S0w=S0w, reflection=reflection, tile=tile)
+
+
+def _trace_tile(start):
+    """ traceTA of every pair in the tile starting at (i, j), see `_svd_rotation`. """
+    i, j = start
+    S0, S0w, tile = _WORKER_DATA['S0'], _WORKER_DATA['S0w'], _WORKER_DATA['tile']
+    reflection = _WORKER_DATA['reflection']
+    X0 = S0[i:i + tile]
+    Y0 = S0w[j:j + tile]
+    n, m = X0.shape[1:]
+
+    # A[a, b] = X0[a].T . Y0[b] for the whole tile as a single matrix product.
+    A = np.dot(X0.transpose(0, 2, 1).reshape(-1, n), Y0.transpose(1, 0, 2).reshape(n, -1))
+    A = A.reshape(len(X0), m, len(Y0), m).transpose(0, 2, 1, 3)
+
+    s = np.linalg.svd(A, compute_uv=False)
+    traces = s.sum(-1)
+    if reflection != 'best':
+        # The unconstrained solution is a reflection when det(A) < 0, forcing the other flips the
+        # smallest singular value.
+        flip = (np.linalg.det(A) < 0) != reflection
+        traces -= 2. * flip * s[..., -1]
+
+    return i, j, traces
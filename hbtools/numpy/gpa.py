@@ -0,0 +1,103 @@
+"""
+Generalized Procrustes Analysis, aligns a stack of shapes to their common consensus (mean) shape.
+"""
+
+import timeit
+import numpy as np
+
+from hbtools.numpy.procrustus import procrustes_batch
+
+
+def generalized_procrustes(shapes, reference=0, scaling=True, reflection='best', method='svd', weights=None,
+                           tol=1e-10, max_iter=100):
+    """
+    Iteratively aligns all shapes to their mean until the mean shape converges.
+
+        d, Z, tform, mean, info = generalized_procrustes(shapes)
+
+    Every iteration is a single `procrustes_batch` call of the current mean against the whole stack,
+    so there is no per-shape Python overhead.
+
+    Inputs:
+    ------------
+    shapes
+        (K, N, m) stack of shapes with corresponding points.
+
+    reference
+        index into shapes or an (N, m) array used as the initial mean. the
+        consensus keeps its centroid and centred norm, which fixes the
+        otherwise arbitrary position and size of the mean.
+
+    scaling, reflection, method, weights
+        see `procrustes_batch`.
+
+    tol
+        convergence tolerance on the change of the mean shape, relative to
+        its centred sum of squares.
+
+    max_iter
+        maximum number of iterations.
+
+    Outputs
+    ------------
+    d
+        (K,) residuals of every shape against the final mean.
+
+    Z
+        (K, N, m) shapes aligned to the final mean.
+
+    tform
+        stacked transformations, see `procrustes_batch`.
+
+    mean
+        (N, m) consensus shape.
+
+    info
+        a dict with 'iterations', 'converged', and per iteration lists of
+        the summed 'residuals', the mean 'changes' and the 'timings' in
+        seconds.
+
+    """
+
+    shapes = np.asarray(shapes, dtype=float)
+    if shapes.ndim != 3:
+        raise ValueError("Expected a (K, N, m) stack of shapes, got shape {}".format(shapes.shape))
+
+    if np.ndim(reference) == 0:
+        mean = shapes[reference].copy()
+    else:
+        mean = np.array(reference, dtype=float)
+
+    centroid = mean.mean(0)
+    norm = np.sqrt(((mean - centroid)**2.).sum())
+
+    info = {'iterations': 0, 'converged': False, 'residuals': [], 'changes': [], 'timings': []}
+    for _ in range(max_iter):
+        start = timeit.default_timer()
+
+        d, Z, tform = procrustes_batch(mean, shapes, scaling=scaling, reflection=reflection, method=method,
+                                       weights=weights)
+
+        # New mean, normalized back to the position and size of the reference.
+        new_mean = Z.mean(0)
+        new_mean -= new_mean.mean(0)
+        new_mean *= norm / np.sqrt((new_mean**2.).sum())
+        new_mean += centroid
+
+        change = ((new_mean - mean)**2.).sum() / norm**2.
+        mean = new_mean
+
+        info['iterations'] += 1
+        info['residuals'].append(float(d.sum()))
+        info['changes'].append(float(change))
+        info['timings'].append(timeit.default_timer() - start)
+
+        if change <= tol:
+            info['converged'] = True
+            break
+
+    # Final alignment against the converged mean.
+    d, Z, tform = procrustes_batch(mean, shapes, scaling=scaling, reflection=reflection, method=method,
+                                   weights=weights)
+
+    return d, Z, tform, mean, info
@@ -6,7 +6,7 @@ For personal use only.
 import numpy as np
 
 
-def procrustes(X, Y, scaling=True, reflection='best'):
+def procrustes(X, Y, scaling=True, reflection='best', method='svd', weights=None, dtype=None):
     """
     A port of MATLAB's `procrustes` function to Numpy.
 
@@ -34,11 +34,34 @@ def procrustes(X, Y, scaling=True, reflection='best'):
         best. setting reflection to True or False forces a solution with
         reflection or no reflection respectively.
 
+    method
+        'svd' (default) solves the rotation with a general SVD, 'horn' uses
+        the closed-form quaternion solution which is only available for 3D
+        coordinates but avoids the SVD and determinant checks. 'horn' pays
+        off on stacks (see `procrustes_batch`), for a single pair its numpy
+        call overhead makes it slower than one 3x3 SVD, so single pairs
+        (here and in `ProcrustesReference.align`) use the SVD, which finds
+        the same rotation.
+
+    weights
+        optional (N,) non-negative per-point weights, e.g. marker confidences.
+        the centroids, norms and rotation are computed from the weighted
+        points only, a zero weight drops a point from the fit while it is
+        still transformed into Z.
+
+    dtype
+        floating point type of the centred copies and Z, defaults to
+        float64. float32 halves the memory of dense inputs, sums,
+        covariances and the rotation solve are still accumulated in
+        float64. see `procrustes_chunked` for inputs that do not fit in
+        memory.
+
     Outputs
     ------------
     d
         the residual sum of squared errors, normalized according to a
-        measure of the scale of X, ((X - X.mean(0))**2).sum()
+        measure of the scale of X, ((X - X.mean(0))**2).sum(). both are
+        weighted when weights are given.
 
     Z
         the matrix of transformed Y-values
@@ -49,48 +72,413 @@ def procrustes(X, Y, scaling=True, reflection='best'):
 
     """
 
-    n,m = X.shape
-    ny,my = Y.shape
+    dtype = np.float64 if dtype is None else dtype
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+
+    w = _as_pair_weights(weights, X.shape[0], dtype)
+    return _align_pair(_centre(X, w), Y, w, scaling, reflection, _pair_method(method, X.shape[1]))
 
-    muX = X.mean(0)
-    muY = Y.mean(0)
 
-    X0 = X - muX
-    Y0 = Y - muY
+def procrustes_batch(X, Y, scaling=True, reflection='best', method='svd', weights=None, out=None, dtype=None):
+    """
+    Stacked version of `procrustes`, aligns every frame of Y to the matching
+    frame of X in a single pass using broadcasting and a stacked SVD.
 
-    ssX = (X0**2.).sum()
-    ssY = (Y0**2.).sum()
+        d, Z, tform = procrustes_batch(X, Y)
+
+    Inputs:
+    ------------
+    X, Y
+        stacks of target and input coordinates of shape (F, N, m). X may also
+        be a single (N, m) reference that is broadcast against every frame of
+        Y. Y may have fewer dimensions (columns) than X.
+
+    scaling, reflection, method, dtype
+        see `procrustes`, applied to every frame.
+
+    weights
+        optional per-point weights, either (N,) shared by all frames or
+        (F, N) for per-frame confidences, see `procrustes`.
+
+    out
+        optional preallocated (F, N, m) array that receives Z.
+
+    Outputs
+    ------------
+    d
+        (F,) array of residuals, see `procrustes`.
+
+    Z
+        (F, N, m) array of transformed Y-values.
+
+    tform
+        a dict of stacked transformations, 'rotation' (F, my, m),
+        'scale' (F,) and 'translation' (F, m).
+
+    """
+
+    dtype = np.float64 if dtype is None else dtype
+    X = np.asarray(X, dtype=dtype)
+    Y = np.asarray(Y, dtype=dtype)
+    if X.ndim == 2:
+        X = X[np.newaxis]
+    if Y.ndim == 2:
+        Y = Y[np.newaxis]
+
+    w = _as_weights(weights, X.shape[1], dtype)
+    return _align(_centre(X, w), Y, w, scaling, reflection, method, out)
+
+
+class ProcrustesReference(object):
+    """ A target X prepared once for aligning many Y against it.
+
+    The centroid, centred and normalized copy and norms of X are computed on construction, aligning
+    only does the Y-side work and the rotation solve:
+
+        reference = ProcrustesReference(neutral)
+        d, Z, tform = reference.align(Y)
+        d, Z, tform = reference.align_batch(Ys, out=Z_buffer)
+
+    The scaling, reflection, method, weights and dtype arguments are those of `procrustes` and apply to
+    every alignment against this reference.
+    """
+    def __init__(self, X, scaling=True, reflection='best', method='svd', weights=None, dtype=None):
+        self._dtype = np.float64 if dtype is None else dtype
+        X = np.asarray(X, dtype=self._dtype)
+        if X.ndim != 2:
+            raise ValueError("Expected an (N, m) reference, got shape {}".format(X.shape))
+
+        self.scaling = scaling
+        self.reflection = reflection
+        self.method = method
+
+        self._weights = _as_weights(weights, X.shape[0], self._dtype)
+        self._reference = _centre(X[np.newaxis], self._weights)
+        self._pair_weights = _as_pair_weights(weights, X.shape[0], self._dtype)
+        self._pair_reference = _centre(X, self._pair_weights)
+        self._dimensions = X.shape[1]
+
+    def align(self, Y, out=None):
+        """ Aligns a single (N, my) Y, returns d, Z, tform like `procrustes`. Z is written to out if given. """
+        Y = np.asarray(Y, dtype=self._dtype)
+        return _align_pair(self._pair_reference, Y, self._pair_weights, self.scaling, self.reflection,
+                           _pair_method(self.method, self._dimensions), out)
+
+    def align_batch(self, Y, out=None):
+        """ Aligns an (F, N, my) stack, returns d, Z, tform like `procrustes_batch`. Z is written to out if given. """
+        Y = np.asarray(Y, dtype=self._dtype)
+        return _align(self._reference, Y, self._weights, self.scaling, self.reflection, self.method, out)
+
+
+def procrustes_stream(X, chunks, scaling=True, reflection='best', method='svd', weights=None, smoothing=0.,
+                      dtype=None):
+    """
+    Temporally coherent Procrustes of an animation stream against a fixed
+    target, a generator yielding d, Z, tform (see `procrustes_batch`) per
+    chunk so takes of any length are processed in constant memory:
+
+        chunks = (Y[i:i + 1000] for i in range(0, len(Y), 1000))
+        for d, Z, tform in procrustes_stream(neutral, chunks, smoothing=0.5):
+            ...
+
+    With reflection 'best' the handedness is decided on the first frame and
+    enforced on all later frames, so the solution never flips between a
+    rotation and a reflection. The rotations are filtered in the same pass,
+    each frame's quaternion is kept in the hemisphere of the previous frame
+    (also across chunks) and, for smoothing > 0, exponentially filtered:
+
+        q[t] = normalize(smoothing * q[t-1] + (1 - smoothing) * q_fit[t])
+
+    which matches SLERP filtering closely for the small per-frame rotations
+    of a take. Scale, translation, d and Z are re-fitted to the filtered
+    rotation. Smoothing requires 3D coordinates.
+    """
+    reference = ProcrustesReference(X, scaling=scaling, reflection=reflection, method=method, weights=weights,
+                                    dtype=dtype)
+    rotation_filter = _RotationFilter(reflection, method, smoothing)
+    if smoothing and reference._reference[1].shape[2] != 3:
+        raise ValueError("Rotation smoothing requires 3D coordinates")
+
+    for Y in chunks:
+        Y = np.asarray(Y, dtype=reference._dtype)
+        yield _align(reference._reference, Y, reference._weights, scaling, reference.reflection, method, None,
+                     rotation_filter)
+
+        # Once decided, solve with the fixed handedness directly.
+        if rotation_filter.reflection is not None:
+            reference.reflection = rotation_filter.reflection
+
+
+def procrustes_chunked(X, Y, scaling=True, reflection='best', method='svd', weights=None, dtype=None, out=None,
+                       chunk_size=2**20):
+    """
+    Out-of-core `procrustes` for point sets too large for memory, e.g. np.memmap arrays of dense scans.
+
+        d, Z, tform = procrustes_chunked(np.load(a, mmap_mode='r'), np.load(b, mmap_mode='r'), out=memmap)
+
+    X and Y are read chunk_size points at a time, once for the centroids and once to accumulate the
+    centred covariance and sums of squares in float64. Z is written chunk by chunk into out (e.g. a
+    writable np.memmap), or into a new dtype array, set out=False to skip computing Z. The arguments
+    and outputs are those of `procrustes`.
+    """
+    n, m = X.shape
+    ny, my = Y.shape
+    if n != ny:
+        raise ValueError("X and Y must have the same number of points, got {} and {}".format(n, ny))
+    if weights is not None and len(weights) != n:
+        raise ValueError("Expected {} weights, got {}".format(n, len(weights)))
+
+    chunks = [slice(start, min(start + chunk_size, n)) for start in range(0, n, chunk_size)]
+
+    def _weights(chunk):
+        if weights is None:
+            return 1.
+        return np.asarray(weights[chunk], dtype=np.float64)[:, np.newaxis]
+
+    # Centroids.
+    sum_w = float(n) if weights is None else 0.
+    sumX = np.zeros(m)
+    sumY = np.zeros(my)
+    for chunk in chunks:
+        w = _weights(chunk)
+        if weights is not None:
+            sum_w += w.sum()
+        sumX += (w * X[chunk]).sum(0, dtype=np.float64)
+        sumY += (w * Y[chunk]).sum(0, dtype=np.float64)
+    muX = sumX / sum_w
+    muY = sumY / sum_w
+
+    # Centred sums of squares and covariance.
+    ssX = 0.
+    ssY = 0.
+    A = np.zeros((m, m))
+    for chunk in chunks:
+        w = _weights(chunk)
+        X0 = X[chunk] - muX
+        Y0 = Y[chunk] - muY
+        ssX += (w * X0**2.).sum()
+        ssY += (w * Y0**2.).sum()
+        A[:, :my] += np.dot(X0.T, w * Y0)
 
-    # centred Frobenius norm
     normX = np.sqrt(ssX)
     normY = np.sqrt(ssY)
+    A /= normX * normY
+
+    if method not in _ROTATION_METHODS:
+        raise ValueError("Unknown method {}, expected one of {}".format(method, sorted(_ROTATION_METHODS)))
+    if method == 'horn' and m != 3:
+        raise ValueError("The 'horn' method requires 3D coordinates, got {}D".format(m))
+    T, traceTA = _ROTATION_METHODS[method](A[np.newaxis], reflection)
+
+    d, tform = _transform(muX[np.newaxis], ssX, normX, muY[np.newaxis], ssY, normY, T, traceTA, scaling, my)
+    tform = {'rotation': tform['rotation'][0], 'scale': tform['scale'][0], 'translation': tform['translation'][0]}
+
+    Z = None
+    if out is not False:
+        if out is None:
+            out = np.empty((n, m), dtype=np.float64 if dtype is None else dtype)
+        Z = apply_procrustus_transform(Y, tform, out=out, chunk_size=chunk_size)
+
+    return d[0], Z, tform
+
+
+# Alignment #
+
+
+class _RotationFilter(object):
+    """ Stateful rotation hook for `_align`, enforces a single handedness and filters quaternions across calls. """
+    def __init__(self, reflection, method, smoothing):
+        self.reflection = None if reflection == 'best' else bool(reflection)
+        self._method = method
+        self._smoothing = smoothing
+        self._previous = None           # Last (4,) filtered quaternion.
+
+    def __call__(self, A, T):
+        if not len(T):
+            return T
+
+        have_reflection = np.linalg.det(T) < 0
+        if self.reflection is None:
+            self.reflection = bool(have_reflection[0])
+        wrong = have_reflection != self.reflection
+        if wrong.any():
+            T[wrong] = _ROTATION_METHODS[self._method](A[wrong], self.reflection)[0]
+
+        if T.shape[1] != 3 or not self._smoothing:
+            return T
+
+        # A reflection T = R D with D = diag(1, 1, -1), filter the proper rotation R.
+        if self.reflection:
+            T[:, :, 2] *= -1
+        q = _rotation_to_quaternion(T)
+
+        # Normalized every frame, so the filter runs the same however the take is chunked. Every quaternion is
+        # kept in the hemisphere of its filtered predecessor.
+        alpha = self._smoothing
+        previous = q[0].copy() if self._previous is None else self._previous
+        for i in range(len(q)):
+            current = q[i] if previous.dot(q[i]) >= 0. else -q[i]
+            previous = alpha * previous + (1. - alpha) * current
+            previous /= np.sqrt(previous.dot(previous))
+            q[i] = previous
+        self._previous = previous
+
+        T = _quaternion_to_rotation(q)
+        if self.reflection:
+            T[:, :, 2] *= -1
+
+        return T
+
+
+def _pair_method(method, m):
+    """ The rotation method of a single pair, 'horn' only pays off on stacks and gives way to the SVD. """
+    return 'svd' if method == 'horn' and m == 3 else method
+
+
+def _as_weights(weights, n, dtype=np.float64):
+    """ Per-point weights as an (F or 1, N, 1) array, or None. """
+    if weights is None:
+        return None
+
+    w = np.asarray(weights, dtype=dtype)
+    if w.ndim == 1:
+        w = w[np.newaxis]
+    if w.shape[1] != n:
+        raise ValueError("Expected {} weights per frame, got {}".format(n, w.shape[1]))
+
+    return w[:, :, np.newaxis]
+
+
+def _as_pair_weights(weights, n, dtype=np.float64):
+    """ Per-point weights of a single pair as an (N, 1) array, or None. """
+    if weights is None:
+        return None
+    return _as_weights(weights, n, dtype)[0]
+
+
+def _centre(P, w):
+    """ Centroid, centred unit norm copy, centred sum of squares and norm of a (F, N, m) stack or a
+    single (N, m) shape.
+
+    The copy keeps the type of P, the statistics are accumulated in float64.
+    """
+    if w is None:
+        mu = P.sum(-2, dtype=np.float64) / P.shape[-2]
+    else:
+        mu = (w*P).sum(-2, dtype=np.float64) / w.sum(-2, dtype=np.float64)
+
+    P0 = P - mu[..., np.newaxis, :].astype(P.dtype, copy=False)
+
+    if w is None:
+        ss = (P0**2.).sum((-2, -1), dtype=np.float64)
+    else:
+        ss = (w*P0**2.).sum((-2, -1), dtype=np.float64)
+
+    # centred Frobenius norm
+    norm = np.sqrt(ss)
 
     # scale to equal (unit) norm
-    X0 /= normX
-    Y0 /= normY
+    P0 /= norm[..., np.newaxis, np.newaxis]
+
+    return mu, P0, ss, norm
+
+
+def _align(reference, Y, w, scaling, reflection, method, out, rotation_filter=None):
+    """ Procrustes of Y against an already centred reference, see `procrustes_batch`. """
+    muX, X0, ssX, normX = reference
+    n, m = X0.shape[1:]
+    ny, my = Y.shape[1:]
+    _check_inputs(n, m, ny, method)
+
+    muY, Y0, ssY, normY = _centre(Y, w)
 
     if my < m:
-        Y0 = np.concatenate((Y0, np.zeros(n, m-my)),0)
+        Y0 = np.concatenate((Y0, np.zeros(Y0.shape[:2] + (m-my,), dtype=Y0.dtype)), 2)
+
+    # optimum rotation matrix of Y, one per frame
+    A = _covariance(X0, Y0 if w is None else w*Y0)
+    T, traceTA = _ROTATION_METHODS[method](A, reflection)
+    if rotation_filter is not None:
+        T = rotation_filter(A, T)
+        traceTA = (A * T.transpose(0, 2, 1)).sum((1, 2))
+
+    if out is None:
+        out = np.empty(np.broadcast(X0, Y0).shape, dtype=Y0.dtype)
+    Z = np.matmul(Y0, T.astype(Y0.dtype), out=out)
+
+    # transformed coords
+    if scaling:
+        Z *= (normX*traceTA)[:, np.newaxis, np.newaxis].astype(Z.dtype)
+    else:
+        Z *= normY[:, np.newaxis, np.newaxis].astype(Z.dtype)
+    Z += muX[:, np.newaxis].astype(Z.dtype)
+
+    d, tform = _transform(muX, ssX, normX, muY, ssY, normY, T, traceTA, scaling, my)
+
+    return d, Z, tform
+
+
+def _align_pair(reference, Y, w, scaling, reflection, method, out=None):
+    """ `_align` of a single (N, my) Y against a centred (N, m) reference, without stacking the pair. """
+    muX, X0, ssX, normX = reference
+    n, m = X0.shape
+    ny, my = Y.shape
+    _check_inputs(n, m, ny, method)
+
+    muY, Y0, ssY, normY = _centre(Y, w)
 
-    # optimum rotation matrix of Y
-    A = np.dot(X0.T, Y0)
-    U,s,Vt = np.linalg.svd(A,full_matrices=False)
+    if my < m:
+        Y0 = np.concatenate((Y0, np.zeros((n, m-my), dtype=Y0.dtype)), 1)
+
+    # optimum rotation matrix of Y, single pairs always take the SVD (see `_pair_method`)
+    A = _covariance(X0, Y0 if w is None else w*Y0)
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
     V = Vt.T
     T = np.dot(V, U.T)
 
-    if reflection is not 'best':
+    if reflection != 'best':
 
         # does the current solution use a reflection?
         have_reflection = np.linalg.det(T) < 0
 
         # if that's not what was specified, force another reflection
         if reflection != have_reflection:
-            V[:,-1] *= -1
+            V[:, -1] *= -1
             s[-1] *= -1
             T = np.dot(V, U.T)
 
     traceTA = s.sum()
 
+    Z = np.dot(Y0, T.astype(Y0.dtype, copy=False), out=out)
+
+    # transformed coords
+    Z *= normX*traceTA if scaling else normY
+    Z += muX
+
+    d, tform = _transform(muX, ssX, normX, muY, ssY, normY, T, traceTA, scaling, my)
+
+    return d, Z, tform
+
+
+def _check_inputs(n, m, ny, method):
+    if n != ny:
+        raise ValueError("X and Y must have the same number of points, got {} and {}".format(n, ny))
+    if method not in _ROTATION_METHODS:
+        raise ValueError("Unknown method {}, expected one of {}".format(method, sorted(_ROTATION_METHODS)))
+    if method == 'horn' and m != 3:
+        raise ValueError("The 'horn' method requires 3D coordinates, got {}D".format(m))
+
+
+def _covariance(X0, Y0):
+    """ Stacked or single X0.T . Y0, accumulated in float64. """
+    if X0.dtype == np.float64 and Y0.dtype == np.float64:
+        return np.matmul(X0.swapaxes(-1, -2), Y0)
+    return np.einsum('...ni,...nj->...ij', X0, Y0, dtype=np.float64)
+
+
+def _transform(muX, ssX, normX, muY, ssY, normY, T, traceTA, scaling, my):
+    """ Residuals and tform dict from the statistics of X and Y and the solved rotations. """
     if scaling:
 
         # optimum scaling of Y
@@ -99,25 +487,218 @@ def procrustes(X, Y, scaling=True, reflection='best'):
         # standarised distance between X and b*Y*T + c
         d = 1 - traceTA**2
 
-        # transformed coords
-        Z = normX*traceTA*np.dot(Y0, T) + muX
-
     else:
-        b = 1
+        # [()] keeps a single pair's scale a scalar.
+        b = np.ones(np.shape(traceTA))[()]
         d = 1 + ssY/ssX - 2 * traceTA * normY / normX
-        Z = normY*np.dot(Y0, T) + muX
 
     # transformation matrix
-    if my < m:
-        T = T[:my,:]
-    c = muX - b*np.dot(muY, T)
+    if my < T.shape[-1]:
+        T = T[..., :my, :]
+    c = muX - b[..., np.newaxis]*np.matmul(muY[..., np.newaxis, :], T)[..., 0, :]
 
     #transformation values
     tform = {'rotation':T, 'scale':b, 'translation':c}
 
-    return d, Z, tform
+    return d, tform
 
 
-def apply_procrustus_transform(Y, tform):
-    Z = tform['scale']*np.dot(Y, tform['rotation']) + tform['translation']
-    return Z
+def apply_procrustus_transform(Y, tform, out=None, chunk_size=None):
+    """ Applies scale * Y . rotation + translation from a `procrustes` tform.
+
+    A single tform applies to all points of Y, a stacked tform from `procrustes_batch` applies per frame
+    to an (F, N, m) Y. The result is written to out if given, which may be Y itself to transform in place.
+    Y and out are processed chunk_size rows (frames) at a time so they can be np.memmap arrays larger than
+    memory, in place only a chunk sized buffer is allocated.
+    """
+    # Lists and single (m,) points, memmaps stay memmaps.
+    Y = np.asanyarray(Y)
+    if Y.ndim == 1:
+        Z = apply_procrustus_transform(Y[np.newaxis], tform, None if out is None else out[np.newaxis])
+        return Z[0] if out is None else out
+
+    rotation = np.asarray(tform['rotation'])
+    scale = np.asarray(tform['scale'], dtype=float)
+    translation = np.asarray(tform['translation'])
+    if rotation.ndim == 3:
+        scale = scale[:, np.newaxis, np.newaxis]
+        translation = translation[:, np.newaxis]
+
+    if out is None:
+        out = np.empty(Y.shape[:-1] + rotation.shape[-1:])
+
+    count = Y.shape[0]
+    if chunk_size is None:
+        chunk_size = max(count, 1)
+
+    # Overlapping input and output go through a buffer so no chunk is overwritten before it is read.
+    buffer = None
+    if np.may_share_memory(Y, out):
+        buffer = np.empty((min(chunk_size, count),) + out.shape[1:], dtype=out.dtype)
+
+    for start in range(0, count, chunk_size):
+        chunk = slice(start, min(start + chunk_size, count))
+        Z = out[chunk] if buffer is None else buffer[:chunk.stop - chunk.start]
+        if rotation.ndim == 3:
+            np.matmul(Y[chunk], rotation[chunk], out=Z)
+            Z *= scale[chunk]
+            Z += translation[chunk]
+        else:
+            np.matmul(Y[chunk], rotation, out=Z)
+            Z *= scale
+            Z += translation
+        if buffer is not None:
+            out[chunk] = Z
+
+    return out
+
+
+# Rotation Solvers #
+
+
+def _svd_rotation(A, reflection):
+    """ Optimum (F, m, m) rotations maximizing trace(A T) and their traces, using a stacked SVD. """
+    U, s, Vt = np.linalg.svd(A, full_matrices=False)
+    V = Vt.transpose(0, 2, 1)
+    T = np.matmul(V, U.transpose(0, 2, 1))
+
+    if reflection != 'best':
+
+        # does the current solution use a reflection?
+        have_reflection = np.linalg.det(T) < 0
+
+        # if that's not what was specified, force another reflection
+        flip = have_reflection != reflection
+        if flip.any():
+            V[flip, :, -1] *= -1
+            s[flip, -1] *= -1
+            T[flip] = np.matmul(V[flip], U[flip].transpose(0, 2, 1))
+
+    traceTA = s.sum(1)
+
+    return T, traceTA
+
+
+def _horn_rotation(A, reflection, tol=1e-12, max_iter=50):
+    """ Closed-form 3D counterpart of `_svd_rotation` using Horn's quaternion method.
+
+    The largest eigenvalue of Horn's 4x4 key matrix (which equals traceTA) is found with Newton
+    iterations on its characteristic polynomial, the matching eigenvector (the quaternion) is read
+    from the cofactors of (N - lambda I). Frames where that eigenvector is ill-defined fall back to
+    the SVD solution.
+    """
+    F = A.shape[0]
+
+    # A reflection T = R D with D = diag(1, 1, -1) maximizes trace(D A R), solve that for R instead.
+    detA = _det3(A[:, 0], A[:, 1], A[:, 2])
+    if reflection == 'best':
+        reflect = detA < 0
+    else:
+        reflect = np.full(F, bool(reflection))
+    M = A.copy()
+    M[reflect, 2] *= -1
+    detM = np.where(reflect, -detA, detA)
+
+    Sxx, Sxy, Sxz = M[:, 0, 0], M[:, 0, 1], M[:, 0, 2]
+    Syx, Syy, Syz = M[:, 1, 0], M[:, 1, 1], M[:, 1, 2]
+    Szx, Szy, Szz = M[:, 2, 0], M[:, 2, 1], M[:, 2, 2]
+    N = np.empty((F, 4, 4))
+    N[:, 0] = np.stack((Sxx + Syy + Szz, Syz - Szy, Szx - Sxz, Sxy - Syx), 1)
+    N[:, 1] = np.stack((Syz - Szy, Sxx - Syy - Szz, Sxy + Syx, Szx + Sxz), 1)
+    N[:, 2] = np.stack((Szx - Sxz, Sxy + Syx, -Sxx + Syy - Szz, Syz + Szy), 1)
+    N[:, 3] = np.stack((Sxy - Syx, Szx + Sxz, Syz + Szy, -Sxx - Syy + Szz), 1)
+
+    # det(N - lI) = l^4 + c2 l^2 + c1 l + c0, start above the largest root (the nuclear norm bound).
+    ssM = (M**2.).sum((1, 2))
+    c2 = -2. * ssM
+    c1 = -8. * detM
+    c0 = np.linalg.det(N)
+    lam = np.sqrt(3. * ssM)
+    for _ in range(max_iter):
+        lam2 = lam * lam
+        poly = (lam2 + c2) * lam2 + c1 * lam + c0
+        dpoly = 4. * lam2 * lam + 2. * c2 * lam + c1
+        step = np.divide(poly, dpoly, out=np.zeros(F), where=dpoly != 0)
+        lam = lam - step
+        if (np.abs(step) <= tol * np.maximum(lam, tol)).all():
+            break
+
+    # The null vector of K = N - lI is the generalized cross product of any three of its rows (a column
+    # of its adjugate), expanded from the 2x2 minors of rows (0, 1) and (2, 3). Pick the best conditioned.
+    K = N - lam[:, np.newaxis, np.newaxis] * np.eye(4)
+    q = None
+    q_norm = None
+    for r, (p0, p1), (k0, k1) in ((0, (2, 3), (1, 0)), (2, (0, 1), (3, 2))):
+        m01, m02, m03, m12, m13, m23 = _minors2(K[:, p0], K[:, p1])
+        for k, sign in ((k0, 1.), (k1, -1.)):
+            a0, a1, a2, a3 = K[:, k].T
+            candidate = sign * np.stack((a1*m23 - a2*m13 + a3*m12,
+                                         -a0*m23 + a2*m03 - a3*m02,
+                                         a0*m13 - a1*m03 + a3*m01,
+                                         -a0*m12 + a1*m02 - a2*m01), 1)
+            candidate_norm = np.sqrt((candidate**2.).sum(1))
+            if q is None:
+                q, q_norm = candidate, candidate_norm
+            else:
+                better = candidate_norm > q_norm
+                q[better] = candidate[better]
+                q_norm[better] = candidate_norm[better]
+
+    T = np.empty((F, 3, 3))
+    valid = q_norm > 1e-6 * np.maximum(ssM, tol)**1.5
+    if valid.any():
+        T[valid] = _quaternion_to_rotation(q[valid] / q_norm[valid, np.newaxis])
+        T[valid & reflect, :, 2] *= -1
+    traceTA = lam
+
+    if not valid.all():
+        # Degenerate (e.g. planar or collinear) frames, the quaternion is not unique.
+        invalid = ~valid
+        T[invalid], traceTA[invalid] = _svd_rotation(A[invalid], reflection)
+
+    return T, traceTA
+
+
+def _quaternion_to_rotation(q):
+    """ (F, 3, 3) rotations of (F, 4) unit quaternions (w, x, y, z), row vector convention of `procrustes`. """
+    w, x, y, z = q.T
+    T = np.empty((q.shape[0], 3, 3))
+    T[:, 0] = np.stack((w*w + x*x - y*y - z*z, 2.*(x*y - w*z), 2.*(x*z + w*y)), 1)
+    T[:, 1] = np.stack((2.*(x*y + w*z), w*w - x*x + y*y - z*z, 2.*(y*z - w*x)), 1)
+    T[:, 2] = np.stack((2.*(x*z - w*y), 2.*(y*z + w*x), w*w - x*x - y*y + z*z), 1)
+    return T
+
+
+def _rotation_to_quaternion(T):
+    """ Inverse of `_quaternion_to_rotation`, picks the best conditioned of the four branches per frame. """
+    T00, T11, T22 = T[:, 0, 0], T[:, 1, 1], T[:, 2, 2]
+    diagonal = np.stack((T00 + T11 + T22, T00, T11, T22), 1)
+    branch = diagonal.argmax(1)
+    largest = np.stack((1. + T00 + T11 + T22, 1. + T00 - T11 - T22, 1. - T00 + T11 - T22, 1. - T00 - T11 + T22), 1)
+    largest = np.sqrt(largest[np.arange(T.shape[0]), branch]) / 2.
+
+    wx, wy, wz = T[:, 2, 1] - T[:, 1, 2], T[:, 0, 2] - T[:, 2, 0], T[:, 1, 0] - T[:, 0, 1]
+    xy, xz, yz = T[:, 0, 1] + T[:, 1, 0], T[:, 0, 2] + T[:, 2, 0], T[:, 1, 2] + T[:, 2, 1]
+    candidates = np.stack((np.stack((4. * largest**2., wx, wy, wz), 1),
+                           np.stack((wx, 4. * largest**2., xy, xz), 1),
+                           np.stack((wy, xy, 4. * largest**2., yz), 1),
+                           np.stack((wz, xz, yz, 4. * largest**2.), 1)))
+
+    return candidates[branch, np.arange(T.shape[0])] / (4. * largest[:, np.newaxis])
+
+
+def _det3(a, b, c):
+    """ Stacked determinants of the 3x3 matrices with rows a, b and c. """
+    return (a[:, 0] * (b[:, 1]*c[:, 2] - b[:, 2]*c[:, 1]) +
+            a[:, 1] * (b[:, 2]*c[:, 0] - b[:, 0]*c[:, 2]) +
+            a[:, 2] * (b[:, 0]*c[:, 1] - b[:, 1]*c[:, 0]))
+
+
+def _minors2(a, b):
+    """ Stacked 2x2 minors of the 2x4 matrices with rows a and b, ordered by column pair. """
+    return (a[:, 0]*b[:, 1] - a[:, 1]*b[:, 0], a[:, 0]*b[:, 2] - a[:, 2]*b[:, 0],
+            a[:, 0]*b[:, 3] - a[:, 3]*b[:, 0], a[:, 1]*b[:, 2] - a[:, 2]*b[:, 1],
+            a[:, 1]*b[:, 3] - a[:, 3]*b[:, 1], a[:, 2]*b[:, 3] - a[:, 3]*b[:, 2])
+
+
+_ROTATION_METHODS = {'svd': _svd_rotation, 'horn': _horn_rotation}
@@ -0,0 +1,168 @@
+"""
+Outlier tolerant Procrustes, for marker sets where a few points are swapped or mislabeled.
+"""
+
+import timeit
+import numpy as np
+
+from hbtools.numpy.procrustus import procrustes, procrustes_batch
+
+
+def robust_procrustes(X, Y, mode='ransac', threshold=None, trim=0.2, scaling=True, reflection='best',
+                      method='svd', sample_size=None, max_iter=1000, max_time=None, batch_size=256,
+                      confidence=0.999, seed=0):
+    """
+    Procrustes analysis that ignores outlier points.
+
+        d, Z, tform, inliers = robust_procrustes(X, Y, threshold=0.5)
+
+    Inputs:
+    ------------
+    X, Y
+        (N, m) target and input coordinates, see `procrustes`.
+
+    mode
+        'ransac' (default) samples random minimal subsets, fits all of them
+        with a single weighted `procrustes` call per batch of hypotheses and
+        keeps the one with the most inliers. 'trim' repeatedly fits and drops
+        the `trim` fraction of points with the largest residuals.
+
+    threshold
+        maximum distance between a transformed point of Y and its X
+        counterpart for it to be an inlier, required for 'ransac'.
+
+    trim
+        fraction of points discarded by 'trim'.
+
+    scaling, reflection, method
+        see `procrustes`.
+
+    sample_size
+        number of points per hypothesis, defaults to m + 1.
+
+    max_iter
+        maximum number of hypotheses ('ransac') or fit iterations ('trim').
+
+    max_time
+        optional time budget in seconds, checked between hypothesis batches.
+
+    batch_size
+        number of hypotheses evaluated per batched call.
+
+    confidence
+        'ransac' stops early once a hypothesis with only inliers has been
+        drawn with this probability, given the best inlier ratio so far.
+
+    seed
+        seed for the hypothesis sampling, results are deterministic.
+
+    Outputs
+    ------------
+    d, Z, tform
+        see `procrustes`, fitted on the inliers only. Z contains all points.
+
+    inliers
+        (N,) boolean mask of the points used for the final fit.
+
+    """
+
+    X = np.asarray(X, dtype=float)
+    Y = np.asarray(Y, dtype=float)
+    n, m = X.shape
+
+    if mode == 'ransac':
+        if threshold is None:
+            raise ValueError("The 'ransac' mode requires a threshold")
+        inliers = _ransac_inliers(X, Y, threshold, scaling, reflection, method, sample_size or m + 1,
+                                  max_iter, max_time, batch_size, confidence, seed)
+    elif mode == 'trim':
+        inliers = _trimmed_inliers(X, Y, int(round((1. - trim) * n)), scaling, reflection, method, max_iter)
+    else:
+        raise ValueError("Unknown mode {}, expected 'ransac' or 'trim'".format(mode))
+
+    d, Z, tform = procrustes(X, Y, scaling=scaling, reflection=reflection, method=method,
+                             weights=inliers.astype(float))
+
+    return d, Z, tform, inliers
+
+
+def _residuals(X, Z):
+    """ Squared distances between corresponding points, nan (degenerate fits) counts as infinite. """
+    residuals = ((X - Z)**2.).sum(-1)
+    residuals[np.isnan(residuals)] = np.inf
+    return residuals
+
+
+def _ransac_inliers(X, Y, threshold, scaling, reflection, method, sample_size, max_iter, max_time,
+                    batch_size, confidence, seed):
+    n = X.shape[0]
+    if sample_size > n:
+        raise ValueError("Need at least {} points, got {}".format(sample_size, n))
+
+    rng = np.random.RandomState(seed)
+    start = timeit.default_timer()
+    threshold2 = threshold**2.
+
+    best_inliers = np.ones(n, dtype=bool)
+    best_score = (-1, 0.)
+    required = max_iter
+    evaluated = 0
+    while evaluated < min(required, max_iter):
+        if max_time is not None and evaluated and timeit.default_timer() - start > max_time:
+            break
+
+        # One weight row per hypothesis, a random subset of sample_size points.
+        count = min(batch_size, max_iter - evaluated)
+        samples = rng.rand(count, n).argsort(1)[:, :sample_size]
+        weights = np.zeros((count, n))
+        weights[np.arange(count)[:, np.newaxis], samples] = 1.
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            _, Z, _ = procrustes_batch(X, Y, scaling=scaling, reflection=reflection, method=method,
+                                       weights=weights)
+        residuals = _residuals(X, Z)
+        inliers = residuals <= threshold2
+        counts = inliers.sum(1)
+        costs = np.where(inliers, residuals, 0.).sum(1)
+
+        # Most inliers wins, ties are broken by the lowest inlier residual.
+        best = np.lexsort((costs, -counts))[0]
+        if (counts[best], -costs[best]) > best_score:
+            best_score = (counts[best], -costs[best])
+            best_inliers = inliers[best]
+
+            ratio = counts[best] / float(n)
+            if ratio >= 1.:
+                required = 0
+            elif ratio > 0.:
+                required = np.log(1. - confidence) / np.log(1. - ratio**sample_size)
+
+        evaluated += count
+
+    # Refit on the consensus set until it stops changing.
+    for _ in range(10):
+        if best_inliers.sum() < sample_size:
+            break
+        _, Z, _ = procrustes(X, Y, scaling=scaling, reflection=reflection, method=method,
+                             weights=best_inliers.astype(float))
+        inliers = _residuals(X, Z) <= threshold2
+        if (inliers == best_inliers).all() or inliers.sum() < sample_size:
+            break
+        best_inliers = inliers
+
+    return best_inliers
+
+
+def _trimmed_inliers(X, Y, keep, scaling, reflection, method, max_iter):
+    n = X.shape[0]
+    inliers = np.ones(n, dtype=bool)
+    for _ in range(max_iter):
+        _, Z, _ = procrustes(X, Y, scaling=scaling, reflection=reflection, method=method,
+                             weights=inliers.astype(float))
+        trimmed = np.zeros(n, dtype=bool)
+        trimmed[np.argsort(_residuals(X, Z))[:keep]] = True
+        if (trimmed == inliers).all():
+            break
+        inliers = trimmed
+
+    return inliers
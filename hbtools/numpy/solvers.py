@@ -0,0 +1,1026 @@
+"""
+Non-negative least squares solvers for blendshape weights, min ||B x - b|| subject to x >= 0.
+
+A solver is prepared once with the blendshape matrix B and then solves any number of targets b. B may
+be a dense array or a scipy.sparse matrix, only the (k, k) Gram matrix B^T B is stored dense. All solvers
+share the same interface:
+
+    solver = GramNNLSSolver()
+    solver.prepare(B)
+    weights, error = solver.solve(b)
+"""
+
+import os
+import copy
+import shutil
+import tempfile
+import warnings
+import multiprocessing
+import numpy as np
+import scipy.linalg as la
+import scipy.optimize as sp
+import scipy.sparse
+
+
+def solve_sequence_parallel(solver, targets, processes=None, chunk_size=None, warm_start=True):
+    """ Solves the rows of targets with a prepared solver spread over a pool of worker processes.
+
+    The blendshape matrix is written once to a temporary file, an .npy file that every worker memory
+    maps or, for a sparse matrix, an .npz file that every worker loads. Each worker prepares its own
+    copy of the solver from it, only the solver settings and the target chunks are pickled. Frames are
+    split into chunks of chunk_size (by default four per worker), warm starts only carry over within a
+    chunk. Returns (F, k) weights, (F,) errors and (F,) iterations in frame order.
+
+    Spawned workers (Windows, Maya) re-import the calling module, call this from under a __main__
+    guard. Inside Maya point multiprocessing.set_executable to mayapy first.
+    """
+    targets = np.asarray(targets, dtype=np.float64)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    if chunk_size is None:
+        chunk_size = max(1, -(-len(targets) // (4 * processes)))
+    chunks = [targets[start:start + chunk_size] for start in range(0, len(targets), chunk_size)]
+
+    # Workers get an unprepared copy of the solver, the matrix goes through the memory map.
+    blank = copy.copy(solver)
+    blank.invalidate()
+
+    directory = tempfile.mkdtemp(prefix="hbtools_solve_")
+    try:
+        if scipy.sparse.issparse(solver._matrix):
+            path = os.path.join(directory, "matrix.npz")
+            scipy.sparse.save_npz(path, solver._matrix)
+        else:
+            path = os.path.join(directory, "matrix.npy")
+            np.save(path, np.asarray(solver._matrix))
+
+        pool = multiprocessing.Pool(processes, initializer=_init_worker, initargs=(blank, path))
+        try:
+            results = pool.map(_solve_chunk, [(chunk, warm_start) for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if not results:
+        return np.empty((0, solver._matrix.shape[1])), np.empty(0), np.empty(0, dtype=int)
+
+    weights, errors, iterations = zip(*results)
+    return np.concatenate(weights), np.concatenate(errors), np.concatenate(iterations)
+
+
+def update_rows(solver, matrix, added=None, removed=None):
+    """ Prepares a solver for a matrix that only differs from its prepared matrix by some rows.
+
+    The Gram matrix G = B^T B of the prepared solver is updated with the added and removed rows, G + A^T A
+    - R^T R, instead of being recomputed from the whole matrix. The factorizations are redone, they only
+    depend on the number of targets. Unprepared solvers are prepared from scratch.
+    """
+    gram = getattr(solver, "_gram", None)
+    if gram is None:
+        solver.prepare(matrix)
+        return
+
+    if added is not None and added.shape[0]:
+        gram = gram + _gram(added)
+    if removed is not None and removed.shape[0]:
+        gram = gram - _gram(removed)
+    solver.prepare(matrix, gram=(gram + gram.T) / 2.)
+
+
+_WORKER_SOLVER = []
+
+
+def _init_worker(solver, path):
+    if path.endswith(".npz"):
+        solver.prepare(scipy.sparse.load_npz(path))
+    else:
+        solver.prepare(np.load(path, mmap_mode='r'))
+    _WORKER_SOLVER.append(solver)
+
+
+def _solve_chunk(task):
+    targets, warm_start = task
+    return _WORKER_SOLVER[0].solve_sequence(targets, warm_start=warm_start)
+
+
+class NNLSSolver(object):
+    """ scipy.optimize.nnls on the full matrix for every solve, a sparse matrix is made dense. """
+    def __init__(self):
+        self._matrix = None
+
+    def prepare(self, matrix, gram=None):
+        self._matrix = matrix.toarray() if scipy.sparse.issparse(matrix) else matrix
+
+    def invalidate(self):
+        self._matrix = None
+
+    def solve(self, target):
+        """ Returns the weights and the residual norm ||B x - b||. """
+        return sp.nnls(self._matrix, target)
+
+    def solve_sequence(self, targets, warm_start=True):
+        """ Solves every row of targets, returns (F, k) weights, (F,) errors and (F,) iterations.
+
+        scipy does not report iterations nor support warm starts, iterations are -1.
+        """
+        weights = np.empty((len(targets), self._matrix.shape[1]))
+        errors = np.empty(len(targets))
+        for i, target in enumerate(targets):
+            weights[i], errors[i] = self.solve(target)
+
+        return weights, errors, np.full(len(targets), -1, dtype=int)
+
+
+class GramNNLSSolver(object):
+    """ NNLS on the cached normal equations B^T B x = B^T b.
+
+    The Gram matrix G = B^T B and a square root factor R with R^T R = G (Cholesky, or the eigen
+    decomposition when targets are linearly dependent) are computed once in `prepare`. Since
+
+        ||B x - b||^2 = ||R x - c||^2 + ||b||^2 - ||c||^2    with R^T c = B^T b
+
+    a solve only needs B^T b and an NNLS on the small k x k system, k being the number of targets (plus
+    B x for the residual).
+    When the unconstrained solution is already non-negative the factorization solves it directly. With
+    linearly dependent targets `nnls_active_set` solves the normal equations instead.
+    """
+    def __init__(self, block_size=64, rounds=8):
+        self._block_size = block_size   # Frames solved together by a warm started solve_sequence.
+        self._rounds = rounds
+
+        self._matrix = None
+        self._gram = None
+        self._factor = None
+
+    def prepare(self, matrix, gram=None):
+        self._matrix = matrix
+        self._gram = _gram(matrix) if gram is None else gram
+        self._factor = _GramFactor(self._gram)
+
+    def invalidate(self):
+        self._matrix = None
+        self._gram = None
+        self._factor = None
+
+    def solve(self, target):
+        """ Returns the weights and the residual norm ||B x - b||, like scipy.optimize.nnls. """
+        weights = self._solve_projected(self._matrix.T.dot(target))
+        return weights, np.linalg.norm(self._matrix.dot(weights) - target)
+
+    def solve_sequence(self, targets, warm_start=True):
+        """ Solves every row of targets, returns (F, k) weights, (F,) errors and (F,) iterations.
+
+        With warm_start frames are solved block_size at a time, every block starting from the passive set
+        of the last solved frame of the previous block. The frames of each passive set are solved together
+        for up to rounds rounds of `bvls_batch`, the frames still left, like all frames without warm_start,
+        are solved by `solve`. The iterations are the number of batched rounds, -1 for frames solved by
+        `solve`.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        projected = np.asarray(self._matrix.T.dot(targets.T)).T
+
+        k = self._gram.shape[0]
+        weights = np.empty((len(targets), k))
+        iterations = np.full(len(targets), -1, dtype=int)
+        if not warm_start:
+            for i in range(len(targets)):
+                weights[i] = self._solve_projected(projected[i])
+        else:
+            lower, upper = np.zeros(k), np.full(k, np.inf)
+            previous = None
+            for start in range(0, len(targets), self._block_size):
+                block = slice(start, start + self._block_size)
+                x, rounds, left = _batch_rounds(self._gram, projected[block], lower, upper, previous, 1e-10,
+                                                self._rounds)
+                for i in left:
+                    x[i] = self._solve_projected(projected[block][i], passive=x[i] > 0)
+                    rounds[i] = -1
+                weights[block], iterations[block] = x, rounds
+                previous = x[-1]
+
+        errors = np.sqrt(((np.asarray(self._matrix.dot(weights.T)).T - targets)**2.).sum(1))
+        return weights, errors, iterations
+
+    def _solve_projected(self, projected, passive=None):
+        if not self._factor.is_definite:
+            # scipy's nnls is not reliable on rank deficient systems.
+            weights, _ = nnls_active_set(self._gram, projected, passive=passive)
+            return weights
+
+        c = self._factor.project(projected)
+        weights = self._factor.solve(c)
+        if weights is None or (weights < 0).any():
+            weights, _ = sp.nnls(self._factor.root, c)
+        return weights
+
+
+class RegularizedSolver(object):
+    """ NNLS with ridge (l2) and sparsity (l1) penalties:
+
+        min 1/2 ||B x - b||^2 + 1/2 l2 ||x||^2 + l1 sum(x)    subject to x >= 0
+
+    With x >= 0 the l1 norm is linear, so both penalties keep the problem an NNLS of the normal equations
+    (G + l2 I) x = B^T b - l1 with G = B^T B. The factorization of G + l2 I is cached for a few l2 values
+    and reused by every frame. Any l2 > 0 makes the system positive definite. Reported errors are the
+    data misfit ||B x - b|| only.
+    """
+    def __init__(self, l2=0., l1=0.):
+        self.l2 = l2
+        self.l1 = l1
+
+        self._matrix = None
+        self._gram = None
+        self._systems = {}      # l2: (G + l2 I, factor)
+
+    def prepare(self, matrix, gram=None):
+        self._matrix = matrix
+        self._gram = _gram(matrix) if gram is None else gram
+        self._systems = {}
+
+    def invalidate(self):
+        self._matrix = None
+        self._gram = None
+        self._systems = {}
+
+    def _system(self, l2):
+        if l2 not in self._systems:
+            if len(self._systems) >= _SYSTEM_CACHE_SIZE:
+                self._drop_systems()
+            gram = self._gram + l2 * np.eye(len(self._gram))
+            self._systems[l2] = (gram, _GramFactor(gram))
+        return self._systems[l2]
+
+    def _drop_systems(self):
+        """ Drops the cached systems of all l2 values but the solver's own. """
+        self._systems = dict((l2, system) for l2, system in self._systems.items() if l2 == self.l2)
+
+    def solve(self, target):
+        """ Returns the weights and the residual norm ||B x - b||. """
+        gram, factor = self._system(self.l2)
+        projected = self._matrix.T.dot(target) - self.l1
+
+        weights = None
+        if factor.is_definite:
+            c = factor.project(projected)
+            weights = factor.solve(c)
+            if (weights < 0).any():
+                weights, _ = sp.nnls(factor.root, c)
+        else:
+            weights, _ = nnls_active_set(gram, projected)
+
+        return weights, np.linalg.norm(self._matrix.dot(weights) - target)
+
+    def solve_sequence(self, targets, warm_start=True):
+        """ Solves every row of targets, returns (F, k) weights, (F,) errors and (F,) iterations.
+
+        See GramNNLSSolver.solve_sequence for the warm starts.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        weights, iterations = self._solve_frames(targets, self.l2, self.l1, warm_start)
+        return weights, self._errors(weights, targets), iterations
+
+    def solve_path(self, targets, l2=None, l1=None):
+        """ Solves every row of targets for a sweep of l2 or l1 values, the other penalty stays fixed.
+
+        The sweep runs from the strongest to the weakest penalty, every frame starting from its own
+        solution of the previous penalty, so each step only moves a few variables and a whole path costs
+        about as much as a couple of solve_sequence calls. Returns (L, F, k) weights and (L, F) errors in
+        the order of the given values. Only the system of the solver's own l2 stays cached afterwards.
+        """
+        if (l2 is None) == (l1 is None):
+            raise ValueError("Sweep exactly one of l2 and l1")
+
+        targets = np.asarray(targets, dtype=np.float64)
+        values = np.asarray(l2 if l1 is None else l1, dtype=np.float64)
+
+        weights = np.empty((len(values), len(targets), self._gram.shape[0]))
+        errors = np.empty((len(values), len(targets)))
+        previous = None
+        for i in np.argsort(values)[::-1]:
+            # The first value warm starts along the frames, the following ones from the previous value.
+            if l1 is None:
+                weights[i], _ = self._solve_frames(targets, values[i], self.l1, previous is None, previous)
+            else:
+                weights[i], _ = self._solve_frames(targets, self.l2, values[i], previous is None, previous)
+            errors[i] = self._errors(weights[i], targets)
+            previous = weights[i] > 0
+
+        self._drop_systems()
+        return weights, errors
+
+    def _solve_frames(self, targets, l2, l1, warm_start, passive=None):
+        """ Active-set solves of all frames, starting from the previous frame or the given passive sets. """
+        gram, _ = self._system(l2)
+        projected = np.asarray(self._matrix.T.dot(targets.T)).T - l1
+
+        weights = np.empty((len(targets), len(gram)))
+        iterations = np.empty(len(targets), dtype=int)
+        frame_passive = None
+        for i in range(len(targets)):
+            if passive is not None:
+                frame_passive = passive[i]
+            weights[i], iterations[i] = nnls_active_set(gram, projected[i], passive=frame_passive)
+            if warm_start:
+                frame_passive = weights[i] > 0
+
+        return weights, iterations
+
+    def _errors(self, weights, targets):
+        return np.sqrt(((np.asarray(self._matrix.dot(weights.T)).T - targets)**2.).sum(1))
+
+
+class BoundedLSQSolver(object):
+    """ Box constrained least squares, min ||B x - b|| subject to lower <= x <= upper.
+
+    Blendshape weights live in [0, 1], solving within those bounds fits better than clamping an NNLS
+    result afterwards. Solves the exact bounded-variable active set (`bvls_active_set`) on the cached
+    normal equations, which starts from any weights, e.g. those of the previous frame, and many frames
+    at once with `bvls_batch`. lower and upper are scalars or per-target arrays.
+    """
+    def __init__(self, lower=0., upper=1., tol=1e-10, max_iter=None, block_size=64):
+        self._lower = lower
+        self._upper = upper
+        self._tol = tol
+        self._max_iter = max_iter
+        self._block_size = block_size   # Frames solved together by solve_sequence.
+
+        self._matrix = None
+        self._gram = None
+
+    def set_bounds(self, lower, upper):
+        self._lower = lower
+        self._upper = upper
+
+    def prepare(self, matrix, gram=None):
+        self._matrix = matrix
+        self._gram = _gram(matrix) if gram is None else gram
+
+    def invalidate(self):
+        self._matrix = None
+        self._gram = None
+
+    def solve(self, target, warm_start=None):
+        """ Returns the weights and the residual norm ||B x - b||, optionally starting from given weights. """
+        weights, _ = bvls_active_set(self._gram, self._matrix.T.dot(target), self._lower, self._upper,
+                                     x0=warm_start, tol=self._tol, max_iter=self._max_iter)
+        return weights, np.linalg.norm(self._matrix.dot(weights) - target)
+
+    def solve_sequence(self, targets, warm_start=True):
+        """ Solves every row of targets, returns (F, k) weights, (F,) errors and (F,) iterations.
+
+        Frames are solved block_size at a time by `bvls_batch`. With warm_start every block starts from
+        the last solved frame of the previous block, warm_start may also be an (F, k) array of initial
+        weights. The iterations are the number of batched rounds and active set changes per frame.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        projected = np.asarray(self._matrix.T.dot(targets.T)).T
+
+        weights = np.empty(projected.shape)
+        iterations = np.empty(len(targets), dtype=int)
+        previous = None
+        for start in range(0, len(targets), self._block_size):
+            block = slice(start, start + self._block_size)
+            if isinstance(warm_start, np.ndarray):
+                x0 = warm_start[block]
+            elif warm_start:
+                x0 = previous
+            else:
+                x0 = None
+            weights[block], iterations[block] = bvls_batch(self._gram, projected[block], self._lower, self._upper,
+                                                           x0=x0, tol=self._tol, max_iter=self._max_iter)
+            previous = weights[block][-1]
+
+        errors = np.sqrt(((np.asarray(self._matrix.dot(weights.T)).T - targets)**2.).sum(1))
+        return weights, errors, iterations
+
+
+class TemporalSolver(object):
+    """ Least squares over a whole take with a smoothness penalty on the weight curves:
+
+        min sum_t 1/2 ||B x_t - b_t||^2 + 1/2 smoothness ||D x||^2
+
+    D takes the first (order=1, velocity) or second (order=2, acceleration) differences of every weight
+    along the frames. Smoothing while solving keeps the fit and adds no latency, unlike filtering solved
+    weights. With the frames interleaved (frame t, target j at row t * k + j) the normal equations are
+    block banded with a bandwidth of order * k, so their banded Cholesky factorization costs O(F k^3)
+    time and O(F k^2) memory instead of the O((F k)^3) of the dense system.
+
+    By default the weights stay within [lower, upper], like those of the other solvers they are never
+    negative. The bounded solve takes at most max_iter Newton steps on the banded system until the
+    projected gradient is below tol, see _solve_bounded. bounded=False skips it for the unconstrained
+    least squares weights.
+    """
+    def __init__(self, smoothness=1., order=1, bounded=True, lower=0., upper=1., tol=1e-10, max_iter=100):
+        if order not in (1, 2):
+            raise ValueError("Order must be 1 or 2, got {}".format(order))
+        self.smoothness = smoothness
+        self.order = order
+        self._bounded = bounded
+        self._lower = lower
+        self._upper = upper
+        self._tol = tol
+        self._max_iter = max_iter
+
+        self._matrix = None
+        self._gram = None
+        self._factors = {}      # (free frames, fixed frames): banded Cholesky factor of a stream window.
+
+    def set_bounds(self, lower, upper):
+        self._lower = lower
+        self._upper = upper
+
+    def prepare(self, matrix, gram=None):
+        self._matrix = matrix
+        self._gram = _gram(matrix) if gram is None else gram
+        self._factors = {}
+
+    def invalidate(self):
+        self._matrix = None
+        self._gram = None
+        self._factors = {}
+
+    def solve(self, target):
+        """ Returns the weights and the residual norm ||B x - b|| of a single frame, which has nothing to
+        be smooth with.
+        """
+        weights, _ = self._solve_window(self._project(np.asarray(target, dtype=np.float64)[np.newaxis]))
+        return weights[0], np.linalg.norm(self._matrix.dot(weights[0]) - target)
+
+    def solve_sequence(self, targets, warm_start=True):
+        """ Solves all rows of targets jointly, returns (F, k) weights, (F,) errors and (F,) iterations.
+
+        The frames are one system, warm_start is only there for the common solver interface.
+        """
+        targets = np.asarray(targets, dtype=np.float64)
+        weights, iterations = self._solve_window(self._project(targets))
+        return weights, self._errors(weights, targets), np.full(len(targets), iterations, dtype=int)
+
+    def solve_stream(self, chunks, lookahead=0):
+        """ Sliding window solve of streamed frames, a generator over the (n, k) weights of finished frames.
+
+        chunks is an iterable of (n, 3 * markers) arrays or single frames. Every new frame is solved
+        together with the up to lookahead frames that wait for it, and with the last order finished
+        frames held fixed so the curve continues smoothly. Then the oldest waiting frame is finished, so
+        lookahead is the latency in frames and the frames after the stream ends are yielded last.
+        """
+        finished = np.empty((0, self._gram.shape[0]))
+        waiting = np.empty((0, self._gram.shape[0]))
+
+        done = []
+        for chunk in chunks:
+            chunk = np.asarray(chunk, dtype=np.float64).reshape(-1, self._matrix.shape[0])
+            for frame in self._project(chunk):
+                waiting = np.concatenate([waiting, frame[np.newaxis]])
+                if len(waiting) > lookahead:
+                    weights, _ = self._solve_window(waiting, fixed=finished, cache=True)
+                    finished = np.concatenate([finished, weights[:1]])[-self.order:]
+                    waiting = waiting[1:]
+                    done.append(weights[0])
+            if done:
+                yield np.array(done)
+                done = []
+
+        if len(waiting):
+            weights, _ = self._solve_window(waiting, fixed=finished, cache=True)
+            yield weights
+
+    def _project(self, targets):
+        """ B^T b of every frame, (F, k). """
+        return np.asarray(self._matrix.T.dot(targets.T)).T
+
+    def _errors(self, weights, targets):
+        return np.sqrt(((np.asarray(self._matrix.dot(weights.T)).T - targets)**2.).sum(1))
+
+    def _solve_window(self, projected, fixed=None, cache=False):
+        """ Solves the (F, k) projected frames after the given fixed (p, k) weights, the last p <= order
+        finished frames. Returns (F, k) weights and the active set iterations.
+        """
+        frames, k = projected.shape
+        p = 0 if fixed is None else len(fixed)
+        bands = _difference_bands(p + frames, self.order) * self.smoothness
+
+        # The penalty terms coupling to the fixed frames move to the right hand side.
+        projected = projected.copy()
+        for d in range(1, self.order + 1):
+            for s in range(max(p - d, 0), min(p, p + frames - d)):
+                projected[s + d - p] -= bands[d, s] * fixed[s]
+        bands = bands[:, p:]
+
+        key = (frames, p)
+        factor = self._factors.get(key) if cache else None
+        if factor is None:
+            factor = _banded_cholesky(_banded_system(self._gram, bands))
+            if cache:
+                self._factors[key] = factor
+        weights = la.cho_solve_banded((factor, False), projected.ravel()).reshape(frames, k)
+
+        if not self._bounded:
+            return weights, 0
+
+        return self._solve_bounded(weights, projected, bands)
+
+    def _solve_bounded(self, weights, projected, bands):
+        """ The (F, k) weights within the bounds, starting from the clamped unconstrained ones. Returns the
+        weights and the Newton iterations.
+
+        Scaled gradient projection steps, which find the weights at a bound many at a time, alternate with
+        Newton steps on the banded system of the other weights (More and Toraldo) until the projected
+        gradient vanishes. That usually takes a few Newton steps, but can stall on badly conditioned
+        rigs. Windows of up to _DENSE_VARIABLES weights are then finished exactly by `bvls_active_set` on
+        their dense system, larger ones stop at max_iter with a warning.
+        """
+        frames, k = projected.shape
+        if not frames or not k:
+            return np.zeros((frames, k)), 0
+        lower = np.zeros((frames, k)) + self._lower
+        upper = np.zeros((frames, k)) + self._upper
+        x = np.clip(weights, lower, upper)
+
+        system = _banded_system(self._gram, bands)
+        u = len(system) - 1
+        diagonal = np.maximum(system[u].reshape(frames, k), np.finfo(float).tiny)
+
+        def apply(x):
+            return x.dot(self._gram) + _apply_bands(bands, x)
+
+        def search(x, product, direction):
+            # Armijo backtracking along the projection arc of x + alpha direction.
+            energy = (x * (0.5 * product - projected)).sum()
+            gradient = product - projected
+            alpha = 1.
+            for _ in range(50):
+                x_new = np.clip(x + alpha * direction, lower, upper)
+                product_new = apply(x_new)
+                decrease = energy - (x_new * (0.5 * product_new - projected)).sum()
+                if decrease >= -1e-4 * (gradient * (x_new - x)).sum():
+                    break
+                alpha *= 0.5
+            return x_new, product_new, decrease
+
+        product = apply(x)
+        for iteration in range(self._max_iter + 1):
+            gradient = product - projected
+            # Converged once a diagonally scaled projected gradient step stays put.
+            if np.abs(x - np.clip(x - gradient / diagonal, lower, upper)).max() <= self._tol:
+                return x, iteration
+            if iteration == self._max_iter:
+                break
+
+            # Gradient projection steps until the weights at a bound settle or the steps stop paying off.
+            best = 0.
+            bound = (x <= lower) | (x >= upper)
+            for _ in range(k + 1):
+                x, product, decrease = search(x, product, -(product - projected) / diagonal)
+                best = max(best, decrease)
+                settled = (x <= lower) | (x >= upper)
+                if (settled == bound).all() or decrease <= 0.1 * best:
+                    break
+                bound = settled
+
+            # A Newton step on the weights not pushed against a bound. The held weights get identity rows
+            # and columns, which keeps the system banded.
+            gradient = product - projected
+            held = ((x <= lower) & (gradient > 0.)) | ((x >= upper) & (gradient < 0.))
+            index = np.flatnonzero(held)
+            ab = system.copy()
+            ab[:, index] = 0.
+            for d in range(1, u + 1):
+                ab[u - d, index[index + d < frames * k] + d] = 0.
+            ab[u, index] = 1.
+            rhs = np.where(held, 0., -gradient)
+            direction = la.cho_solve_banded((_banded_cholesky(ab), False), rhs.ravel()).reshape(frames, k)
+            direction[held] = 0.
+            x, product, _ = search(x, product, direction)
+
+        if frames * k <= _DENSE_VARIABLES:
+            x, _ = bvls_active_set(_dense_system(self._gram, bands), projected.ravel(), lower.ravel(),
+                                   upper.ravel(), x0=x.ravel(), tol=self._tol)
+            return x.reshape(frames, k), self._max_iter
+
+        warnings.warn("Bounded temporal solve stopped after {} iterations without converging".format(
+            self._max_iter), RuntimeWarning)
+        return x, self._max_iter
+
+
+class _GramFactor(object):
+    """ Square root R of a Gram matrix, R^T R = G. An upper Cholesky factor, or the scaled eigenvectors of
+    its numerical range when G is singular.
+    """
+    def __init__(self, gram):
+        try:
+            self.root = la.cholesky(gram)
+            self.is_definite = True
+            self._eigenvectors = None
+        except la.LinAlgError:
+            self.is_definite = False
+            values, vectors = la.eigh(gram)
+            keep = values > values[-1] * gram.shape[0] * np.finfo(float).eps
+            self._sqrt_values = np.sqrt(values[keep])
+            self._eigenvectors = vectors[:, keep]
+            self.root = self._sqrt_values[:, np.newaxis] * self._eigenvectors.T
+
+    def project(self, projected):
+        """ c with R^T c = h. """
+        if self._eigenvectors is None:
+            return la.solve_triangular(self.root, projected, trans='T')
+        return self._eigenvectors.T.dot(projected) / self._sqrt_values
+
+    def solve(self, c):
+        """ The unconstrained solution of R x = c, None if R is not square. """
+        if self._eigenvectors is None:
+            return la.solve_triangular(self.root, c)
+        return None
+
+
+# Most (G + l2 I) systems a RegularizedSolver keeps, each holds two (k, k) matrices.
+_SYSTEM_CACHE_SIZE = 4
+
+
+def _gram(matrix):
+    gram = matrix.T.dot(matrix)
+    if scipy.sparse.issparse(gram):
+        gram = gram.toarray()
+    return np.asarray(gram, dtype=np.float64)
+
+
+def nnls_active_set(gram, projected, passive=None, tol=1e-10, max_iter=None):
+    """ Lawson-Hanson active-set NNLS in normal equation form, with an optional warm start.
+
+    Minimizes 1/2 x^T G x - h^T x subject to x >= 0, with G = B^T B and h = B^T b. A given passive set
+    (the variables expected to be positive, e.g. those of the previous frame) is first made feasible by
+    dropping variables that solve non-positive. Returns x and the number of passive set changes.
+    """
+    k = gram.shape[0]
+    free = np.zeros(k, dtype=bool) if passive is None else np.array(passive, dtype=bool)
+    return _active_set(gram, projected, np.zeros(k), np.full(k, np.inf), free, np.zeros(k, dtype=bool),
+                       tol, 3 * k if max_iter is None else max_iter)
+
+
+def bvls_active_set(gram, projected, lower=0., upper=1., x0=None, tol=1e-10, max_iter=None):
+    """ Bounded-variable least squares (Stark-Parker BVLS) in normal equation form, with a warm start.
+
+    Minimizes 1/2 x^T G x - h^T x subject to lower <= x <= upper, scalars or (k,) arrays, with G = B^T B
+    and h = B^T b. Starts from x0, e.g. the weights of the previous frame, whose variables within the
+    bounds are first solved with the others held at their bound and moved to the bound they cross.
+    Terminates at the exact solution, where no variable at a bound has a gradient pointing inwards.
+    Returns x and the number of active set changes.
+    """
+    k = gram.shape[0]
+    lower = np.zeros(k) + lower
+    upper = np.zeros(k) + upper
+    if x0 is None:
+        free = np.zeros(k, dtype=bool)
+        at_upper = np.zeros(k, dtype=bool)
+    else:
+        x0 = np.clip(x0, lower, upper)
+        at_upper = x0 >= upper - tol
+        free = ~at_upper & (x0 > lower + tol)
+    return _active_set(gram, projected, lower, upper, free, at_upper, tol,
+                       3 * k if max_iter is None else max_iter)
+
+
+def bvls_batch(gram, projected, lower=0., upper=1., x0=None, tol=1e-10, max_iter=None, rounds=3):
+    """ `bvls_active_set` of the (F, k) rows of projected, vectorized over frames that share an active set.
+
+    Every frame starts from x0, one (k,) start for all frames or an (F, k) array, or from all variables at
+    their lower bound. The frames of each active set are solved together, one factorization for all of
+    them, and those meeting the optimality conditions are done. The others move the variables that left
+    their bounds onto them and free those whose gradient points inwards, for up to rounds rounds, frames
+    still left are finished one by one by `bvls_active_set`. Returns (F, k) x and the rounds and active
+    set changes per frame.
+    """
+    k = projected.shape[1]
+    lower = np.zeros(k) + lower
+    upper = np.zeros(k) + upper
+    x, iterations, left = _batch_rounds(gram, projected, lower, upper, x0, tol, rounds)
+    for i in left:
+        x[i], changes = bvls_active_set(gram, projected[i], lower, upper, x0=x[i], tol=tol, max_iter=max_iter)
+        iterations[i] += changes
+    return x, iterations
+
+
+def _batch_rounds(gram, projected, lower, upper, x0, tol, rounds):
+    """ The batched rounds of `bvls_batch` on (k,) bounds. Returns (F, k) x, the rounds per frame and the
+    frames not yet optimal, whose x is the clipped solution of their last round.
+    """
+    frames, k = projected.shape
+    iterations = np.zeros(frames, dtype=int)
+    if not frames or not k:
+        return np.zeros((frames, k)), iterations, np.arange(0)
+
+    # -1 held at the lower bound, 1 at the upper bound, 0 free. Variables without a bound are free.
+    start = np.clip(np.zeros((frames, k)) + (lower if x0 is None else x0), lower, upper)
+    state = np.where(start <= lower + tol, -1, np.where(start >= upper - tol, 1, 0)).astype(np.int8)
+    state[(state == -1) & ~np.isfinite(lower)] = 0
+    state[(state == 1) & ~np.isfinite(upper)] = 0
+
+    x = np.empty((frames, k))
+    left = np.arange(frames)
+    for _ in range(rounds):
+        iterations[left] += 1
+        x[left], optimal, state[left] = _solve_states(gram, projected[left], lower, upper, state[left], tol)
+        left = left[~optimal]
+        if not len(left):
+            break
+    return x, iterations, left
+
+
+def _solve_states(gram, projected, lower, upper, state, tol):
+    """ One round of `bvls_batch`, solves the (F, k) rows of projected with the free variables of state.
+
+    Returns the clipped (F, k) x, the (F,) mask of the frames that are optimal and the next state.
+    """
+    x = np.where(state > 0, upper, lower)
+    x[state == 0] = 0.
+    solved = np.ones(len(state), dtype=bool)
+    patterns, groups = np.unique(state, axis=0, return_inverse=True)
+    groups = groups.ravel()
+    for g, pattern in enumerate(patterns):
+        index = np.flatnonzero(pattern == 0)
+        if not len(index):
+            continue
+        rows = np.flatnonzero(groups == g)
+        factor = _PassiveFactor(gram, index)
+        if len(factor.index) < len(index):
+            # Dependent free columns, left to the active set.
+            solved[rows] = False
+            continue
+        rhs = projected[np.ix_(rows, index)] - x[rows].dot(gram[:, index])
+        x[np.ix_(rows, index)] = factor.solve(rhs.T).T
+
+    free = state == 0
+    below = free & (x < lower - tol)
+    above = free & (x > upper + tol)
+    x = np.clip(x, lower, upper)
+    gradient = projected - x.dot(gram)
+    inwards = (((state < 0) & (gradient > tol)) | ((state > 0) & (gradient < -tol))) & (lower < upper)
+    optimal = solved & ~(below | above | inwards).any(1)
+
+    state = state.copy()
+    state[below] = -1
+    state[above] = 1
+    state[inwards] = 0
+    return x, optimal, state
+
+
+def _active_set(gram, projected, lower, upper, free, at_upper, tol, max_iter):
+    """ The active-set iteration of nnls_active_set and bvls_active_set.
+
+    free are the variables solved from the normal equations, all others are held at their upper bound
+    if at_upper, else at their lower one. The Cholesky factor of the free sub-block is factored once
+    and then updated as variables enter and leave, see _PassiveFactor.
+    """
+    k = gram.shape[0]
+    if not k:
+        return np.zeros(0), 0
+    fixed = lower >= upper
+    # Variables without the bound they would be held at are always free.
+    free = (free | ~np.isfinite(np.where(at_upper, upper, lower))) & ~fixed
+    x = np.where(at_upper | fixed, upper, lower)
+
+    # Columns depending on the others are left out of the factor and start at their bound.
+    factor = _PassiveFactor(gram, np.flatnonzero(free))
+    free[:] = False
+    free[factor.index] = True
+    x[~np.isfinite(x)] = 0.
+    # Left out variables without a bound to be held at sit at 0 inside their bounds, where the gradient
+    # may point either way.
+    loose = ((x > lower) & (x < upper) & ~free).any()
+    # Fixed variables, and those whose column depends on the free ones until the free set changes.
+    excluded = fixed.copy()
+    # Without upper bounds, as in NNLS, the gradient sign never flips. Without non-zero bounds the
+    # held variables add nothing to the right hand side.
+    capped = np.isfinite(upper).any()
+    shifted = (x != 0.).any() or (np.isfinite(upper) & (upper != 0.)).any()
+
+    def solve(index):
+        # The free block with the bound variables moved to the right hand side.
+        if shifted:
+            return factor.solve(projected[index] - gram[index].dot(np.where(free, 0., x)))
+        return factor.solve(projected[index])
+
+    def to_bounds(index, values):
+        below = values <= lower[index] + tol
+        above = values >= upper[index] - tol
+        x[index[below]] = lower[index[below]]
+        x[index[above]] = upper[index[above]]
+        leaving = index[below | above]
+        free[leaving] = False
+        factor.remove(leaving)
+
+    iterations = 0
+    while factor.index:
+        index = np.array(factor.index, dtype=int)
+        z = solve(index)
+        if ((z > lower[index] + tol) & (z < upper[index] - tol)).all():
+            x[index] = z
+            break
+        to_bounds(index, z)
+        iterations += 1
+
+    while True:
+        # Inward pointing negative gradient of the variables held at a bound.
+        gradient = projected - gram.dot(x)
+        violation = np.where(x >= upper, -gradient, gradient) if capped else gradient
+        if loose:
+            inside = (x > lower) & (x < upper)
+            violation[inside] = np.abs(gradient[inside])
+        violation[free | excluded] = -np.inf
+        j = violation.argmax()
+        if violation[j] <= tol:
+            break
+        if iterations >= max_iter:
+            warnings.warn("Active set solve stopped after {} iterations without converging".format(max_iter),
+                          RuntimeWarning)
+            break
+
+        if not factor.add(j):
+            excluded[j] = True
+            continue
+        free[j] = True
+        index = np.array(factor.index, dtype=int)
+        z = solve(index)
+        if (z[-1] <= lower[j] + tol) if x[j] <= lower[j] else (x[j] >= upper[j] and z[-1] >= upper[j] - tol):
+            # Only rounding keeps the entering variable at its bound, leave it out for now.
+            factor.remove([j])
+            free[j] = False
+            excluded[j] = True
+            continue
+        iterations += 1
+
+        while True:
+            lo, hi, current = lower[index], upper[index], x[index]
+            below = z <= lo + tol
+            above = z >= hi - tol
+            if not (below | above).any():
+                break
+
+            # Step towards z up to the first bound and hold the variables that reach one.
+            with np.errstate(divide='ignore', invalid='ignore'):
+                steps = np.where(below, (current - lo) / (current - z),
+                                 np.where(above, (hi - current) / (z - current), 1.))
+            alpha = min(np.where(steps > 0., steps, 0.).min(), 1.)
+            x[index] = current + alpha * (z - current)
+            to_bounds(index, x[index])
+            iterations += 1
+
+            index = np.array(factor.index, dtype=int)
+            z = solve(index)
+
+        x[index] = z
+        excluded = fixed.copy()
+
+    return x, iterations
+
+
+class _PassiveFactor(object):
+    """ Upper Cholesky factor R of the Gram sub-block of an ordered set of variables, R^T R = G[s, s].
+
+    A variable entering appends a row and column to R, O(p^2) for p variables. Variables leaving
+    delete their columns, only the block behind the first of them is refactored. Active-set iterations,
+    which move a variable or two per pivot, never refactor the whole block.
+    """
+    def __init__(self, gram, index=()):
+        self._gram = gram
+        self.index = []
+        self.root = np.empty((0, 0), order='F')
+
+        index = [int(j) for j in index]
+        if index:
+            root, info = la.lapack.dpotrf(gram[np.ix_(index, index)], lower=0, clean=1)
+            if info == 0:
+                self.root = root
+                self.index = index
+            else:
+                for j in index:
+                    self.add(j)
+
+    def add(self, j):
+        """ Appends variable j, False if its column depends on those of the set. """
+        column = _triangular(self.root, self._gram[self.index, j], trans=1)
+        pivot = self._gram[j, j] - column.dot(column)
+        if pivot <= self._gram[j, j] * _DEPENDENT or pivot <= 0.:
+            return False
+
+        p = len(self.index)
+        root = np.zeros((p + 1, p + 1), order='F')
+        root[:p, :p] = self.root
+        root[:p, p] = column
+        root[p, p] = np.sqrt(pivot)
+        self.root = root
+        self.index.append(j)
+        return True
+
+    def remove(self, variables):
+        """ Drops the given variables from the set. """
+        drop = np.isin(self.index, variables)
+        if not drop.any():
+            return
+        first = drop.argmax()
+        keep = np.flatnonzero(~drop)
+
+        root = np.zeros((len(keep), len(keep)), order='F')
+        root[:first] = self.root[:first, keep]
+        # The kept columns behind the first removed one are upper Hessenberg below it, their R factor
+        # is the new trailing block.
+        trailing = self.root[first:, keep[first:]]
+        if trailing.size:
+            qr = la.lapack.dgeqrf(trailing)[0]
+            root[first:, first:] = np.triu(qr[:trailing.shape[1]])
+        self.root = root
+        self.index = [self.index[i] for i in keep]
+
+    def solve(self, rhs):
+        """ G[s, s]^-1 rhs. """
+        return _triangular(self.root, _triangular(self.root, rhs, trans=1))
+
+
+def _triangular(root, rhs, trans=0):
+    """ Solves R x = rhs, or R^T x = rhs with trans=1, straight through LAPACK. The scipy wrapper costs more
+    than the solve itself for the small systems of an active-set pivot.
+    """
+    if not len(rhs):
+        return np.empty(0)
+    x, _ = la.lapack.dtrtrs(root, rhs, lower=0, trans=trans)
+    return x
+
+
+# Fraction of a column's squared norm left outside the span of the passive columns below which it counts
+# as dependent on them.
+_DEPENDENT = 1e3 * np.finfo(float).eps
+
+
+def _difference_bands(frames, order):
+    """ The bands of D^T D for the order-th difference operator D over frames, bands[d, t] is the entry
+    (t, t + d). The last d entries of band d are unused.
+    """
+    stencil = np.diff(np.eye(order + 1), n=order, axis=0)[0]
+    rows = max(frames - order, 0)
+    bands = np.zeros((order + 1, frames))
+    for d in range(order + 1):
+        for i in range(order + 1 - d):
+            bands[d, i:i + rows] += stencil[i] * stencil[i + d]
+    return bands
+
+
+# Largest number of weights, frames times targets, of a window whose bounded solve may fall back to
+# the dense system, 2048 weights take 32 MB.
+_DENSE_VARIABLES = 2048
+
+
+def _dense_system(gram, bands):
+    """ I (x) G + L (x) I in interleaved order as a dense matrix, L given by its bands. """
+    k = len(gram)
+    frames = bands.shape[1]
+    system = np.kron(np.eye(frames), gram)
+    diagonal = np.arange(frames * k)
+    system[diagonal, diagonal] += np.repeat(bands[0], k)
+    for d in range(1, min(len(bands), frames)):
+        offset = diagonal[:-d * k]
+        values = np.repeat(bands[d, :frames - d], k)
+        system[offset, offset + d * k] += values
+        system[offset + d * k, offset] += values
+    return system
+
+
+def _banded_system(gram, bands):
+    """ Upper band storage of I (x) G + L (x) I in interleaved order, L given by its bands, see
+    scipy.linalg.cholesky_banded.
+    """
+    k = len(gram)
+    order = len(bands) - 1
+    frames = bands.shape[1]
+    u = max(k - 1, order * k)
+
+    ab = np.zeros((u + 1, frames * k))
+    rows, cols = np.triu_indices(k)
+    ab[u + rows - cols, np.arange(frames)[:, np.newaxis] * k + cols] = gram[rows, cols]
+    ab[u] += np.repeat(bands[0], k)
+    for d in range(1, min(order + 1, frames)):
+        ab[u - d * k, d * k:] += np.repeat(bands[d, :frames - d], k)
+    return ab
+
+
+def _banded_cholesky(ab):
+    """ Upper banded Cholesky factor of a system in upper band storage.
+
+    A singular system, from collinear targets with a penalty that leaves constant curves free, gets a
+    tiny ridge.
+    """
+    try:
+        return la.cholesky_banded(ab)
+    except la.LinAlgError:
+        ab = ab.copy()
+        ab[-1] += max(ab[-1].max(), 1.) * len(ab) * np.finfo(float).eps * 1e3
+        return la.cholesky_banded(ab)
+
+
+def _apply_bands(bands, x):
+    """ (L (x) I) x of (F, k) frames x with L given by its bands. """
+    y = bands[0][:, np.newaxis] * x
+    for d in range(1, min(len(bands), len(x))):
+        y[:-d] += bands[d, :-d, np.newaxis] * x[d:]
+        y[d:] += bands[d, :-d, np.newaxis] * x[:-d]
+    return y